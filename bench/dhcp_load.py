@@ -0,0 +1,251 @@
+import argparse, json, os, random, select, socket, struct, sys, tempfile, threading, time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dhns.mux import Multiplexer
+from dhns.dhcp import Handler
+from dhns.dhcp.server import UdpServer
+from dhns.dhcp.memory_pool import MemoryPool
+from dhns.dhcp.proto.packet import Packet
+import dhns.dhcp.proto as proto
+
+BUCKETS = 10
+
+STEPS = {
+    proto.DHCPDISCOVER: 'discover', proto.DHCPREQUEST: 'request', 'renew': 'renew',
+    proto.DHCPRELEASE: 'release', proto.DHCPDECLINE: 'decline',
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def summary(values):
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 3) if values else None,
+        'p99_ms': round(percentile(values, 99) * 1000, 3) if values else None,
+    }
+
+
+class Client:
+    def __init__(self, idx):
+        self.chaddr = struct.pack('!HI', 0x0200, idx)
+        self.xid = random.getrandbits(32)
+        self.ipaddr = None
+        self.server = None
+        self.step = None
+        self.sent = 0
+
+    def packet(self, msg_type):
+        packet = Packet()
+        packet.op = 1
+        packet.htype = 1
+        packet.hlen = 6
+        packet.xid = self.xid
+        packet.chaddr = self.chaddr
+        packet.opts[proto.DHCPOPT_MSG_TYPE] = bytes((msg_type,))
+        packet.opts[proto.DHCPOPT_MSG_PARA] = bytes((1, 3, 6, 12, 15, 28, 51, 54))
+        return packet
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.latency = {}
+        self.occupancy = [[] for _ in range(BUCKETS)]
+        self.allocation = [[] for _ in range(BUCKETS)]
+        self.timeouts = Counter()
+        self.naks = 0
+
+    def start_server(self):
+        os.chdir(tempfile.mkdtemp(prefix='dhns-bench-'))
+
+        self.pool = MemoryPool(
+            address=self.args.address,
+            netmask=self.args.netmask,
+            domain=b'bench',
+            lease_time=3600,
+        )
+        self.size = self.pool.pool.last - self.pool.pool.first + 1
+
+        allocate = self.pool.allocate
+
+        def timed(s_hwaddr):
+            bucket = self.bucket(len(self.pool.leases) + len(self.pool.offers))
+            started = time.perf_counter()
+            try:
+                return allocate(s_hwaddr)
+            finally:
+                self.allocation[bucket].append(time.perf_counter() - started)
+
+        self.pool.allocate = timed
+
+        handler = Handler()
+        handler.add_middleware(self.pool, 50)
+        self.server = UdpServer(
+            (self.args.address, self.args.port), handler,
+            interface_rate=self.args.interface_rate, interface_burst=self.args.interface_rate
+        )
+        self.mux = Multiplexer(self.server)
+        threading.Thread(target=self.mux.start, daemon=True).start()
+
+    def bucket(self, used):
+        return min(BUCKETS - 1, used * BUCKETS // self.size)
+
+    def run(self):
+        self.start_server()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.args.address, 0))
+        sock.setblocking(False)
+        target = (self.args.address, self.args.port)
+
+        pending = [Client(idx) for idx in range(self.args.clients)]
+        inflight = {}
+        leased = 0
+        transactions = 0
+
+        def send(client, step, packet):
+            client.step = step
+            client.sent = time.perf_counter()
+            inflight[client.xid] = client
+            sock.sendto(packet.pack(), target)
+
+        def discover(client):
+            client.xid = random.getrandbits(32)
+            send(client, proto.DHCPDISCOVER, client.packet(proto.DHCPDISCOVER))
+
+        def request(client, renew=False):
+            # rfc 2131: a renewal starts a transaction of its own
+            if renew:
+                client.xid = random.getrandbits(32)
+            packet = client.packet(proto.DHCPREQUEST)
+            if renew:
+                packet.ciaddr = client.ipaddr
+            else:
+                packet.opts[proto.DHCPOPT_IPADDR] = client.ipaddr
+                packet.opts[proto.DHCPOPT_SERVER_ID] = client.server
+            send(client, 'renew' if renew else proto.DHCPREQUEST, packet)
+
+        def finish(client, msg_type):
+            client.xid = random.getrandbits(32)
+            packet = client.packet(msg_type)
+            packet.ciaddr = client.ipaddr
+            send(client, msg_type, packet)
+
+        started = time.perf_counter()
+        idle = 0
+
+        while pending or inflight:
+            while pending and len(inflight) < self.args.concurrency:
+                discover(pending.pop())
+
+            ready, _, _ = select.select([sock], [], [], self.args.timeout)
+            if not ready:
+                # the wait is the timeout itself, not server time, so rates leave it out
+                self.timeouts.update(STEPS[client.step] for client in inflight.values())
+                idle += self.args.timeout
+                inflight.clear()
+                continue
+
+            while True:
+                try:
+                    data = sock.recv(1500)
+                except BlockingIOError:
+                    break
+
+                reply = Packet.parse(data)
+                client = inflight.pop(reply.xid, None)
+                if client is None:
+                    continue
+
+                elapsed = time.perf_counter() - client.sent
+                step = client.step
+                self.latency.setdefault(STEPS[step], []).append(elapsed)
+                transactions += 1
+
+                if reply.get_dhcp_type() == proto.DHCPNAK:
+                    self.naks += 1
+                    continue
+
+                if step == proto.DHCPDISCOVER:
+                    self.occupancy[self.bucket(leased)].append(elapsed)
+                    client.ipaddr = bytes(reply.yiaddr)
+                    client.server = reply.opts.get(proto.DHCPOPT_SERVER_ID)
+                    request(client)
+                elif step in (proto.DHCPREQUEST, 'renew'):
+                    if step == proto.DHCPREQUEST:
+                        leased += 1
+                    roll = random.random()
+                    if step == proto.DHCPREQUEST and roll < self.args.renew:
+                        request(client, renew=True)
+                    elif roll < self.args.renew + self.args.decline:
+                        leased -= 1
+                        finish(client, proto.DHCPDECLINE)
+                    elif roll < self.args.renew + self.args.decline + self.args.release:
+                        leased -= 1
+                        finish(client, proto.DHCPRELEASE)
+
+        duration = time.perf_counter() - started
+        busy = max(duration - idle, 1e-9)
+        self.mux.stop()
+
+        return {
+            'clients': self.args.clients,
+            'concurrency': self.args.concurrency,
+            'pool_size': self.size,
+            'duration_s': round(duration, 3),
+            'idle_s': round(idle, 3),
+            'transactions': transactions,
+            'transactions_per_s': round(transactions / busy, 1),
+            'leases_per_s': round(len(self.latency.get('request', [])) / busy, 1),
+            'timeouts': dict(self.timeouts),
+            'naks': self.naks,
+            'server': dict(self.server.stats),
+            'latency': {name: summary(values) for (name, values) in sorted(self.latency.items())},
+            'occupancy': [
+                {
+                    'fill_pct': [idx * 100 // BUCKETS, (idx + 1) * 100 // BUCKETS],
+                    'discover': summary(self.occupancy[idx]),
+                    'allocate': summary(self.allocation[idx]),
+                }
+                for idx in range(BUCKETS)
+            ],
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DHCP DORA load generator for MemoryPool')
+    parser.add_argument('--clients', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--netmask', default='255.255.240.0')
+    parser.add_argument('--port', type=int, default=16767)
+    parser.add_argument('--renew', type=float, default=0.2)
+    parser.add_argument('--release', type=float, default=0.05)
+    parser.add_argument('--decline', type=float, default=0.01)
+    parser.add_argument('--timeout', type=float, default=2.0)
+    parser.add_argument('--interface-rate', type=float, default=1000000)
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args()
+
+    if args.output != '-':
+        args.output = os.path.abspath(args.output)
+
+    result = json.dumps(Bench(args).run(), indent=2)
+
+    if args.output == '-':
+        print(result)
+    else:
+        with open(args.output, 'w') as fh:
+            fh.write(result + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -11,10 +11,11 @@ PRIO_LOWEST = 0
 
 class Server():
     def __init__(self):
-        self.dns  = dhns.dns.Handler()
+        self.dns  = dhns.dns.Handler(cache_size=int(getenv("DNSCACHE", 4 * 1024 * 1024)))
         self.dhcp = dhns.dhcp.Handler()
         self.mul  = Multiplexer(
-             dhns.dns.server.UdpServer(('', int(getenv("DNSPORT",  5353))), self.dns),
+             dhns.dns.server.UdpServer(('', int(getenv("DNSPORT",  5353))), self.dns, workers=int(getenv("DNSWORKERS", 16))),
+             dhns.dns.server.TcpServer(('', int(getenv("DNSPORT",  5353))), self.dns, workers=int(getenv("DNSWORKERS", 16))),
             dhns.dhcp.server.UdpServer(('', int(getenv("DHCPPORT", 6767))), self.dhcp)
         )
 
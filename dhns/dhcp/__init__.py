@@ -1,3 +1,4 @@
+from socket import inet_aton, inet_ntoa
 from dhns.dhcp.proto.packet import Packet
 
 
@@ -5,23 +6,81 @@ class Middleware:
     def handle_dhcp_packet(self, interface, query: Packet, answer: Packet):
         raise NotImplemented
 
+    def subnets(self):
+        return ()
+
+    def tick(self):
+        pass
+
 
 class Handler:
     def __init__(self):
         self.middleware = []
+        self._interfaces = {}
+        self._subnets = []
+        self._fallback = []
 
     def add_middleware(self, middleware: Middleware, priority):
         self.middleware.append((middleware, priority))
         self._sort()
+        self._index()
 
     def handle(self, interface, query: Packet):
         answer = query.reply()
 
-        for middleware in self.middleware:
-            if middleware[0].handle_dhcp_packet(interface, query, answer):
-                return answer, middleware[0]
+        middleware = self.route(interface, query)
+        if middleware and middleware.handle_dhcp_packet(interface, query, answer):
+            return answer, middleware
+
+        for middleware in self._fallback:
+            if middleware.handle_dhcp_packet(interface, query, answer):
+                return answer, middleware
 
         return answer, None
 
+    def route(self, interface, query: Packet):
+        if any(query.giaddr):
+            return self._lookup(bytes(query.giaddr))
+
+        try:
+            return self._interfaces[interface]
+        except KeyError:
+            pass
+
+        try:
+            return self._lookup(inet_aton(interface))
+        except (OSError, TypeError):
+            return None
+
+    def tick(self):
+        for middleware in self.middleware:
+            middleware[0].tick()
+
+    def _lookup(self, address):
+        b_address = int.from_bytes(address, 'big')
+        for (netmask, networks) in self._subnets:
+            middleware = networks.get(b_address & netmask)
+            if middleware:
+                return middleware
+        return None
+
+    def _index(self):
+        interfaces, subnets, fallback = {}, {}, []
+
+        for (middleware, _) in self.middleware:
+            routes = middleware.subnets()
+            if not routes:
+                fallback.append(middleware)
+
+            for (address, netmask) in routes:
+                b_address, b_netmask = int.from_bytes(address, 'big'), int.from_bytes(netmask, 'big')
+                interfaces.setdefault(inet_ntoa(address), middleware)
+                subnets.setdefault(b_netmask, {}).setdefault(b_address & b_netmask, middleware)
+
+        # longest prefix first
+        self._interfaces = interfaces
+        self._subnets = sorted(subnets.items(), reverse=True)
+        self._fallback = fallback
+
     def _sort(self):
         self.middleware.sort(key=lambda tup: tup[1], reverse=True)
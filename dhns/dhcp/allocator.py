@@ -0,0 +1,67 @@
+FREE = 0
+USED = 1
+BLOCKED = 2
+
+
+class Allocator:
+    def __init__(self, first: bytes, last: bytes, ranges=None, exclude=None):
+        self.first = self.aton_int(first)
+        self.last = self.aton_int(last)
+
+        # a /31 or /32 leaves nothing between network and broadcast to hand out
+        self._map = bytearray(max(0, self.last - self.first + 1))
+        self._next = 0
+
+        if ranges:
+            self._fill(self.first, self.last, BLOCKED)
+            for (start, end) in ranges:
+                self._fill(self.aton_int(start), self.aton_int(end), FREE)
+
+        for addr in exclude or ():
+            self.block(addr)
+
+    def allocate(self):
+        idx = self._map.find(FREE, self._next)
+        if idx < 0:
+            idx = self._map.find(FREE, 0, self._next)
+        if idx < 0:
+            return None
+
+        self._map[idx] = USED
+        self._next = idx + 1
+
+        return (self.first + idx).to_bytes(4, 'big')
+
+    def available(self, addr: bytes):
+        idx = self._idx(addr)
+        return idx is not None and self._map[idx] == FREE
+
+    def take(self, addr: bytes):
+        idx = self._idx(addr)
+        if idx is not None and self._map[idx] == FREE:
+            self._map[idx] = USED
+
+    def free(self, addr: bytes):
+        idx = self._idx(addr)
+        if idx is not None and self._map[idx] == USED:
+            self._map[idx] = FREE
+
+    def block(self, addr: bytes):
+        idx = self._idx(addr)
+        if idx is not None:
+            self._map[idx] = BLOCKED
+
+    def _idx(self, addr):
+        idx = self.aton_int(addr) - self.first
+        if 0 <= idx < len(self._map):
+            return idx
+        return None
+
+    def _fill(self, start, end, state):
+        start, end = max(start, self.first), min(end, self.last)
+        if start <= end:
+            self._map[start - self.first:end - self.first + 1] = bytes([state]) * (end - start + 1)
+
+    @classmethod
+    def aton_int(cls, addr):
+        return int.from_bytes(addr, 'big')
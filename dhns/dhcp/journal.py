@@ -0,0 +1,161 @@
+import os, io, dbm, pickle, shelve, threading, time, atexit, logging
+
+PUT = 1
+DEL = 2
+
+
+# file name suffixes the dbm backends behind shelve may have used
+SHELVE_SUFFIXES = ('', '.db', '.dat', '.dir', '.bak')
+
+
+class Journal:
+    def __init__(self, path, delay=0.05, compact=4096, upgrade=None):
+        self._snapshot = '%s.snapshot' % path
+        self._journal = '%s.journal' % path
+        self._delay = delay
+        self._compact = compact
+
+        fresh = not os.path.exists(self._snapshot) and not os.path.exists(self._journal)
+
+        self._data = {}
+        self._records = self._replay()
+        if fresh:
+            self._migrate(path, upgrade)
+
+        self._pending = []
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self._fh = open(self._journal, 'ab')
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+        atexit.register(self.close)
+
+    def items(self):
+        with self._cond:
+            return list(self._data.items())
+
+    def __setitem__(self, key, value):
+        self._append((PUT, key, value))
+
+    def pop(self, key, default=None):
+        self._append((DEL, key, None))
+        return default
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._fh.close()
+
+    def _append(self, event):
+        with self._cond:
+            self._pending.append(event)
+            if len(self._pending) == 1:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+
+            # let more events pile up, then pay for a single fsync
+            if not self._closed:
+                time.sleep(self._delay)
+
+            with self._cond:
+                batch, self._pending = self._pending, []
+                for event in batch:
+                    self._apply(event)
+
+            try:
+                buf = io.BytesIO()
+                for event in batch:
+                    pickle.dump(event, buf)
+                self._fh.write(buf.getvalue())
+                self._fh.flush()
+                os.fsync(self._fh.fileno())
+
+                self._records += len(batch)
+                if self._records >= self._compact:
+                    self._snapshot_write()
+            except OSError:
+                logging.exception('dhcp: journal write failed')
+
+    def _apply(self, event):
+        op, key, value = event
+        if op == PUT:
+            self._data[key] = value
+        else:
+            self._data.pop(key, None)
+
+    def _snapshot_write(self):
+        with self._cond:
+            data = dict(self._data)
+
+        self._dump(data)
+
+        # replaying an old journal over the new snapshot is harmless, so a crash here loses nothing
+        self._fh.close()
+        self._fh = open(self._journal, 'wb')
+        self._records = 0
+
+    def _dump(self, data):
+        tmp = '%s.tmp' % self._snapshot
+        with open(tmp, 'wb') as fh:
+            pickle.dump(data, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self._snapshot)
+
+    def _migrate(self, path, upgrade):
+        # one time import of the shelve this journal replaced
+        try:
+            with shelve.open(path, 'r') as db:
+                data = {key: upgrade(value) if upgrade else value for (key, value) in db.items()}
+        except dbm.error:
+            return
+
+        self._data = data
+        self._dump(data)
+
+        for suffix in SHELVE_SUFFIXES:
+            if os.path.exists(path + suffix):
+                os.rename(path + suffix, '%s.imported%s' % (path, suffix))
+
+        logging.info('dhcp: imported %d entries from shelve %s', len(data), path)
+
+    def _replay(self):
+        try:
+            with open(self._snapshot, 'rb') as fh:
+                self._data = pickle.load(fh)
+        except FileNotFoundError:
+            pass
+
+        records = 0
+        try:
+            with open(self._journal, 'rb+') as fh:
+                offset = 0
+                while True:
+                    try:
+                        event = pickle.load(fh)
+                    except EOFError:
+                        break
+                    except Exception:
+                        logging.warning('dhcp: dropping torn journal tail at %d', offset)
+                        fh.truncate(offset)
+                        break
+                    self._apply(event)
+                    offset = fh.tell()
+                    records += 1
+        except FileNotFoundError:
+            pass
+
+        return records
@@ -0,0 +1,102 @@
+from dhns.timers import Deadlines
+import dhns.dhcp.proto as proto
+
+
+class Table:
+    def __init__(self, store=None, on_change=None):
+        self._store = store
+        self._on_change = on_change
+        self._hwaddr = {}
+        self._ipaddr = {}
+        self._hostname = {}
+        self._reverse = {}
+        self._expires = Deadlines()
+
+        if store is not None:
+            for (hwaddr, lease) in store.items():
+                self._hwaddr[hwaddr] = lease
+                self._index(hwaddr, lease)
+                self._expires.schedule(hwaddr, lease[2])
+
+    def __contains__(self, hwaddr):
+        return hwaddr in self._hwaddr
+
+    def __iter__(self):
+        return iter(self._hwaddr)
+
+    def __len__(self):
+        return len(self._hwaddr)
+
+    def __getitem__(self, hwaddr):
+        return self._hwaddr[hwaddr]
+
+    def __setitem__(self, hwaddr, lease):
+        old = self._hwaddr.get(hwaddr)
+        if old is not None:
+            self._unindex(hwaddr, old)
+
+        self._hwaddr[hwaddr] = lease
+        self._index(hwaddr, lease)
+        self._expires.schedule(hwaddr, lease[2])
+
+        if self._store is not None:
+            self._store[hwaddr] = lease
+
+        if self._on_change is not None:
+            if old is not None:
+                self._on_change(old)
+            self._on_change(lease)
+
+    def get(self, hwaddr, default=None):
+        return self._hwaddr.get(hwaddr, default)
+
+    def pop(self, hwaddr, default=None):
+        lease = self._hwaddr.pop(hwaddr, None)
+        if lease is None:
+            return default
+
+        self._unindex(hwaddr, lease)
+        self._expires.cancel(hwaddr)
+
+        if self._store is not None:
+            self._store.pop(hwaddr, None)
+
+        if self._on_change is not None:
+            self._on_change(lease)
+
+        return lease
+
+    def expire(self, now):
+        for hwaddr in list(self._expires.expired(now)):
+            yield hwaddr, self.pop(hwaddr)
+
+    def items(self):
+        return self._hwaddr.items()
+
+    def owner(self, ipaddr):
+        return self._ipaddr.get(ipaddr)
+
+    def hostname_lease(self, hostname):
+        return self._hostname.get(hostname.lower())
+
+    def ip_lease(self, ipaddr):
+        return self._reverse.get(ipaddr)
+
+    def _index(self, hwaddr, lease):
+        self._ipaddr[lease[0]] = hwaddr
+
+        # names are case insensitive in dns
+        hostname = lease[1].get(proto.DHCPOPT_HOSTNAME)
+        if hostname:
+            self._hostname[hostname.lower()] = lease
+            self._reverse[lease[0]] = lease
+
+    def _unindex(self, hwaddr, lease):
+        if self._ipaddr.get(lease[0]) == hwaddr:
+            del self._ipaddr[lease[0]]
+
+        hostname = lease[1].get(proto.DHCPOPT_HOSTNAME)
+        if hostname and self._hostname.get(hostname.lower()) is lease:
+            del self._hostname[hostname.lower()]
+        if hostname and self._reverse.get(lease[0]) is lease:
+            del self._reverse[lease[0]]
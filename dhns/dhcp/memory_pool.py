@@ -1,22 +1,49 @@
-import struct, logging, shelve
+import struct, logging, threading, time, copy
 from socket import inet_ntoa, inet_aton
-from dnslib import RR, DNSRecord, RDMAP, QTYPE
-from dhns.dhcp.proto.packet import Packet
+from dnslib import RR, DNSRecord, DNSLabel, RDMAP, QTYPE, RCODE, SOA
+from cachetools import LRUCache
+from dhns.dhcp.proto.packet import Packet, encode
 from dhns.dhcp import Middleware
+from dhns.dhcp.leases import Table
+from dhns.dhcp.journal import Journal
+from dhns.dhcp.allocator import Allocator
 from dhns.dns import Middleware as DnsMiddleware
 import dhns.dhcp.proto as proto
 
+# sent even when the client did not ask for them
+REQUIRED_OPTIONS = (proto.DHCPOPT_NETMASK, proto.DHCPOPT_LEASE_TIME)
+
+# answers never outlive the lease behind them, misses are cached only briefly
+MAX_TTL = 3600
+NEGATIVE_TTL = 60
+# longest client supplied hostname we echo back, one dns label
+MAX_HOSTNAME = 63
+
+
 # todo: merge lease/offer
-# todo: inject lease time
-# todo: handle expiration
 class MemoryPool(Middleware, DnsMiddleware):
-    def __init__(self, address=None, netmask=None, nameservers=None, gateway=None, domain=None, entries=None):
+    def __init__(self, address=None, netmask=None, nameservers=None, gateway=None, domain=None, entries=None,
+                 ranges=None, exclude=None, lease_time=3600, offer_time=60):
         self.domain = domain
+        self.lease_time = lease_time
+        self.offer_time = offer_time
         self.address = inet_aton(address)
         self.netmask = inet_aton(netmask)
+        self.interface = address
 
+        self.network = bytes([(a & b) for (a, b) in zip(self.address, self.netmask)])
         self.broadcast = bytes([(a | ~b & 255) for (a, b) in zip(self.address, self.netmask)])
 
+        # reverse zone on the closest octet boundary covering the subnet
+        prefix = bin(Allocator.aton_int(self.netmask)).count('1')
+        self.reverse = DNSLabel([b'%d' % octet for octet in reversed(self.network[:prefix // 8])] + [b'in-addr', b'arpa'])
+
+        # dns worker threads share these, and an lru get reorders the cache
+        self.records = LRUCache(4096)
+        self._records_lock = threading.Lock()
+        self.soa = self.get_soa(DNSLabel(domain))
+        self.reverse_soa = self.get_soa(self.reverse)
+
         if nameservers:
             self.resolvers = bytearray()
             for ns in nameservers:
@@ -29,10 +56,14 @@ class MemoryPool(Middleware, DnsMiddleware):
         else:
             self.gateway = None
 
-        self.leases = shelve.open('%s.leases' % domain.decode('utf8'))
-        self.offers = shelve.open('%s.offers' % domain.decode('utf8'))
+        self.handler = None
+        self.leases = Table(
+            Journal('%s.leases' % domain.decode('utf8'), upgrade=self.upgrade_lease), on_change=self.invalidate_lease
+        )
+        self.offers = Table()
 
         self.entries = entries if entries else {}
+        self.blocks = LRUCache(4096)
 
         self.reserved = {}
         for (k, v) in self.entries.items():
@@ -40,33 +71,129 @@ class MemoryPool(Middleware, DnsMiddleware):
             if addr:
                 self.reserved[inet_aton(addr)] = True
 
+        self.pool = Allocator(
+            (Allocator.aton_int(self.network) + 1).to_bytes(4, 'big'),
+            (Allocator.aton_int(self.broadcast) - 1).to_bytes(4, 'big'),
+            ranges=[(inet_aton(start), inet_aton(end)) for (start, end) in ranges or ()],
+            exclude=[inet_aton(addr) for addr in exclude or ()]
+        )
+
+        for addr in (self.address, self.gateway, *self.reserved):
+            if addr:
+                self.pool.block(addr)
+
+        for (_, entry) in self.leases.items():
+            self.pool.take(entry[0])
+
+    def subnets(self):
+        return [(self.address, self.netmask)]
+
+    def zones(self):
+        zones = [self.reverse.add('*')]
+        if self.domain:
+            zones += [self.domain, DNSLabel(self.domain).add('*')]
+        return zones
+
+    def bind(self, handler):
+        self.handler = handler
+
+    def upgrade_lease(self, lease):
+        # shelved leases from before expiry tracking get a fresh term
+        if len(lease) > 2:
+            return tuple(lease)
+        return (lease[0], lease[1], time.time() + self.lease_time)
+
+    def invalidate_lease(self, lease):
+        if self.handler is None:
+            return
+
+        names = [DNSLabel([b'%d' % octet for octet in reversed(lease[0])] + [b'in-addr', b'arpa'])]
+        hostname = lease[1].get(proto.DHCPOPT_HOSTNAME)
+        if hostname and self.domain:
+            names.append(DNSLabel(self.domain).add(hostname))
+        self.handler.invalidate(names)
+
     def handle_dhcp_packet(self, interface, query: Packet, answer: Packet):
-        if interface == inet_ntoa(self.address):
+        if any(query.giaddr):
+            if not self.addr_in_network(query.giaddr):
+                return
+            # relayed clients reach us through the address the relay talked to
+            answer.opts[proto.DHCPOPT_SERVER_ID] = inet_aton(interface) if interface else self.address
+        elif interface == self.interface or interface and self.addr_in_network(inet_aton(interface)):
             answer.opts[proto.DHCPOPT_SERVER_ID] = self.address
-            msg_type, = struct.unpack('!B', query.opts.get(proto.DHCPOPT_MSG_TYPE))
-            if msg_type == proto.DHCPDISCOVER:
-                self.handle_discover(query, answer)
-            elif msg_type == proto.DHCPREQUEST:
-                self.handle_request(query, answer)
-            elif msg_type == proto.DHCPDECLINE:
-                self.handle_decline(query, answer)
-            elif msg_type == proto.DHCPRELEASE:
-                self.handle_release(query, answer)
-            else:
-                logging.info('dhcp: unsupported request type: %s' % msg_type)
-            return True
+        else:
+            return
+
+        msg_type, = struct.unpack('!B', query.opts.get(proto.DHCPOPT_MSG_TYPE))
+        if msg_type == proto.DHCPDISCOVER:
+            self.handle_discover(query, answer)
+        elif msg_type == proto.DHCPREQUEST:
+            self.handle_request(query, answer)
+        elif msg_type == proto.DHCPDECLINE:
+            self.handle_decline(query, answer)
+        elif msg_type == proto.DHCPRELEASE:
+            self.handle_release(query, answer)
+        else:
+            logging.info('dhcp: unsupported request type: %s' % msg_type)
+        return True
+
+    def tick(self):
+        now = time.time()
+        for (table, kind) in ((self.leases, 'lease'), (self.offers, 'offer')):
+            for (s_hwaddr, entry) in table.expire(now):
+                logging.info('dhcp: %s expired - %s', kind, s_hwaddr)
+                self.free(entry[0])
 
     def handle_dns_packet(self, query: DNSRecord, answer: DNSRecord):
         if self.domain and query.q.qname.matchSuffix(self.domain):
-            if query.q.qtype in (QTYPE.A, QTYPE.ANY):
-                dnsname = query.q.qname.stripSuffix(self.domain)
-                ipaddr  = self.get_hostname_ip(dnsname.label[-1])
-                if ipaddr:
-                    answer.add_answer(
-                        RR(rname=query.q.qname, rtype=QTYPE.A, ttl=3600, rdata=RDMAP["A"](inet_ntoa(ipaddr)))
-                    )
+            return self.handle_forward(query, answer)
+
+        if query.q.qname.matchSuffix(self.reverse):
+            return self.handle_reverse(query, answer)
+
+    def handle_forward(self, query: DNSRecord, answer: DNSRecord):
+        answer.header.aa = 1
+
+        dnsname = query.q.qname.stripSuffix(self.domain)
+        if not dnsname.label:
+            if query.q.qtype in (QTYPE.SOA, QTYPE.ANY):
+                answer.add_answer(self.soa)
+            else:
+                answer.add_auth(self.soa)
             return self
 
+        lease = self.leases.hostname_lease(dnsname.label[-1])
+        if lease is None:
+            answer.header.rcode = RCODE.NXDOMAIN
+            answer.add_auth(self.soa)
+        elif query.q.qtype in (QTYPE.A, QTYPE.ANY):
+            answer.add_answer(self.get_record(query.q.qname, QTYPE.A, inet_ntoa(lease[0]), lease[2]))
+        else:
+            answer.add_auth(self.soa)
+        return self
+
+    def handle_reverse(self, query: DNSRecord, answer: DNSRecord):
+        labels = query.q.qname.label
+        if len(labels) != 6 or not all(label.isdigit() and int(label) < 256 for label in labels[:4]):
+            return
+
+        ipaddr = bytes(int(label) for label in reversed(labels[:4]))
+        if not self.addr_in_network(ipaddr):
+            return
+
+        answer.header.aa = 1
+
+        lease = self.leases.ip_lease(ipaddr)
+        hostname = lease[1].get(proto.DHCPOPT_HOSTNAME) if lease else None
+        if not hostname:
+            answer.header.rcode = RCODE.NXDOMAIN
+            answer.add_auth(self.reverse_soa)
+        elif query.q.qtype in (QTYPE.PTR, QTYPE.ANY):
+            answer.add_answer(self.get_record(query.q.qname, QTYPE.PTR, DNSLabel(self.domain).add(hostname), lease[2]))
+        else:
+            answer.add_auth(self.reverse_soa)
+        return self
+
     def handle_discover(self, query: Packet, answer: Packet):
         b_hwaddr = query.chaddr
         s_hwaddr = self.fmt_hwaddr(b_hwaddr, query.hlen)
@@ -74,24 +201,22 @@ class MemoryPool(Middleware, DnsMiddleware):
 
         logging.info('dhcp: discover - %s', s_hwaddr)
 
-        lease, offer = self.leases.pop(s_hwaddr, None), self.offers.pop(s_hwaddr, None)
+        lease, offer = self.drop(s_hwaddr)
 
         if b_ipaddr is None:
-            b_ipaddr = offer[0] if offer else self.allocate(s_hwaddr)
-        elif self.get_ip_hwaddr(self.offers, b_ipaddr):
-            b_ipaddr = self.allocate(s_hwaddr)
-        elif self.get_ip_hwaddr(self.leases, b_ipaddr):
-            b_ipaddr = self.allocate(s_hwaddr)
+            b_ipaddr = offer[0] if offer else lease[0] if lease else self.allocate(s_hwaddr)
         elif not self.addr_in_network(b_ipaddr):
             b_ipaddr = self.allocate(s_hwaddr)
+        elif not self.pool.available(b_ipaddr):
+            b_ipaddr = self.allocate(s_hwaddr)
 
         options = self.get_options(s_hwaddr, query)
-        self.offers[s_hwaddr] = (b_ipaddr, options)
+        self.offers[s_hwaddr] = (b_ipaddr, options, time.time() + self.offer_time)
+        self.pool.take(b_ipaddr)
 
         answer.opts[proto.DHCPOPT_MSG_TYPE] = struct.pack('!B', proto.DHCPOFFER)
         answer.yiaddr = b_ipaddr
-        for (k, v) in options.items():
-            answer.opts[k] = v
+        answer.block = self.get_block(s_hwaddr, options, query)
 
     def handle_request(self, query: Packet, answer: Packet):
         b_hwaddr = query.chaddr
@@ -100,27 +225,25 @@ class MemoryPool(Middleware, DnsMiddleware):
 
         logging.info('dhcp: request - %s', s_hwaddr)
 
-        lease, offer = self.leases.pop(s_hwaddr, None), self.offers.pop(s_hwaddr, None)
+        lease, offer = self.drop(s_hwaddr)
 
         if offer:
-            b_ipaddr, options = offer
+            b_ipaddr, options = offer[0], offer[1]
         else:
             if b_ipaddr is None:
-                b_ipaddr = self.allocate(s_hwaddr)
-            elif self.get_ip_hwaddr(self.offers, b_ipaddr):
-                b_ipaddr = self.allocate(s_hwaddr)
-            elif self.get_ip_hwaddr(self.leases, b_ipaddr):
-                b_ipaddr = self.allocate(s_hwaddr)
+                b_ipaddr = lease[0] if lease else self.allocate(s_hwaddr)
             elif not self.addr_in_network(b_ipaddr):
                 b_ipaddr = self.allocate(s_hwaddr)
+            elif not self.pool.available(b_ipaddr):
+                b_ipaddr = self.allocate(s_hwaddr)
             options = self.get_options(s_hwaddr, query)
 
-        self.leases[s_hwaddr] = (b_ipaddr, options)
+        self.leases[s_hwaddr] = (b_ipaddr, options, time.time() + self.lease_time)
+        self.pool.take(b_ipaddr)
 
         answer.opts[proto.DHCPOPT_MSG_TYPE] = struct.pack('!B', proto.DHCPACK)
         answer.yiaddr = b_ipaddr
-        for (k, v) in options.items():
-            answer.opts[k] = v
+        answer.block = self.get_block(s_hwaddr, options, query)
 
     def handle_decline(self, query: Packet, answer: Packet):
         b_hwaddr = query.chaddr
@@ -128,8 +251,10 @@ class MemoryPool(Middleware, DnsMiddleware):
 
         logging.info('dhcp: decline - %s', s_hwaddr)
 
-        self.leases.pop(s_hwaddr, None)
-        self.offers.pop(s_hwaddr, None)
+        # address is in use by someone else, keep it out of the pool
+        for entry in self.drop(s_hwaddr):
+            if entry:
+                self.pool.block(entry[0])
 
         answer.opts[proto.DHCPOPT_MSG_TYPE] = struct.pack('!B', proto.DHCPACK)
 
@@ -139,8 +264,7 @@ class MemoryPool(Middleware, DnsMiddleware):
 
         logging.info('dhcp: release - %s', s_hwaddr)
 
-        self.leases.pop(s_hwaddr, None)
-        self.offers.pop(s_hwaddr, None)
+        self.drop(s_hwaddr)
 
         answer.opts[proto.DHCPOPT_MSG_TYPE] = struct.pack('!B', proto.DHCPACK)
 
@@ -149,37 +273,46 @@ class MemoryPool(Middleware, DnsMiddleware):
         if hostopts and hostopts.get("address"):
             return inet_aton(hostopts.get("address"))
 
-        address = struct.unpack('!I', self.address)[0]
-        netsize = ~struct.unpack('!I', self.netmask)[0] & 0xffffffff - 2
-
-        allocated = None
-        for candidate in range(address + 1, address + netsize - 1):
-            candidate = struct.pack('!I', candidate)
-            if self.get_ip_hwaddr(self.offers, candidate):
-                continue
-            if self.get_ip_hwaddr(self.leases, candidate):
-                continue
-            if self.reserved.get(candidate):
-                continue
-            allocated = candidate
-            break
-
+        allocated = self.pool.allocate()
         if allocated is None:
             raise Exception('pool full')
 
         return allocated
 
-    def get_hostname_ip(self, hostname):
-        for idx in self.leases:
-            if self.leases[idx][1].get(proto.DHCPOPT_HOSTNAME, None) == hostname:
-                return self.leases[idx][0]
-        return None
+    def drop(self, s_hwaddr):
+        lease, offer = self.leases.pop(s_hwaddr, None), self.offers.pop(s_hwaddr, None)
+
+        for entry in (lease, offer):
+            if entry:
+                self.free(entry[0])
+
+        return lease, offer
+
+    def free(self, b_ipaddr):
+        if not self.leases.owner(b_ipaddr) and not self.offers.owner(b_ipaddr):
+            self.pool.free(b_ipaddr)
+
+    def get_record(self, qname, qtype, value, expires):
+        key = (str(qname).lower(), qtype, str(value))
+        with self._records_lock:
+            record = self.records.get(key)
+            if record is None:
+                record = self.records[key] = RR(rname=qname, rtype=qtype, ttl=MAX_TTL, rdata=RDMAP[QTYPE[qtype]](value))
+
+        record = copy.copy(record)
+        record.rname = qname
+        record.ttl = max(0, min(MAX_TTL, int(expires - time.time())))
+        return record
+
+    def get_soa(self, zone):
+        times = (int(time.time()), 3600, 600, 86400, NEGATIVE_TTL)
+        return RR(rname=zone, rtype=QTYPE.SOA, ttl=NEGATIVE_TTL, rdata=SOA(zone.add('ns'), zone.add('hostmaster'), times))
 
     def get_options(self, hwaddr, query):
         options = {
             proto.DHCPOPT_NETMASK: self.netmask,
             proto.DHCPOPT_BROADCAST: self.broadcast,
-            proto.DHCPOPT_LEASE_TIME: struct.pack('!I', 3600),
+            proto.DHCPOPT_LEASE_TIME: struct.pack('!I', int(self.lease_time)),
             proto.DHCPOPT_DOMAIN: self.domain
         }
 
@@ -195,23 +328,41 @@ class MemoryPool(Middleware, DnsMiddleware):
 
         if self.entries.get(hwaddr, {}).get("hostname"):
             options[proto.DHCPOPT_HOSTNAME] = bytes(self.entries.get(hwaddr).get("hostname"), 'ascii')
-        elif query.opts.get(proto.DHCPOPT_HOSTNAME):
+        elif 0 < len(query.opts.get(proto.DHCPOPT_HOSTNAME, b'')) <= MAX_HOSTNAME:
+            # the client's name goes back out and into dns, a single label is all it may be
             options[proto.DHCPOPT_HOSTNAME] = query.opts[proto.DHCPOPT_HOSTNAME]
         elif not options.get(proto.DHCPOPT_HOSTNAME):
             options[proto.DHCPOPT_HOSTNAME] = bytes(hwaddr, 'ascii')
 
         return options
 
+    def get_block(self, hwaddr, options, query):
+        prl = query.opts.get(proto.DHCPOPT_MSG_PARA)
+        if prl is not None:
+            prl = bytes(prl)
+
+        cached = self.blocks.get(hwaddr)
+        if cached is None or cached[0] != options:
+            cached = self.blocks[hwaddr] = (options, {code: encode(code, val) for (code, val) in options.items()}, {})
+        _, encoded, blocks = cached
+
+        block = blocks.get(prl)
+        if block is None:
+            if prl is None:
+                codes = list(encoded)
+            else:
+                codes = [code for code in dict.fromkeys(prl) if code in encoded]
+                codes.extend(code for code in REQUIRED_OPTIONS if code not in codes and code in encoded)
+            block = blocks[prl] = b''.join([encoded[code] for code in codes])
+
+        return block
+
+    def invalidate(self):
+        self.blocks.clear()
+
     def addr_in_network(self, b_ipaddr):
         address = bytes([(a & b) for (a, b) in zip(b_ipaddr, self.netmask)])
-        return address == self.address
-
-    @classmethod
-    def get_ip_hwaddr(cls, dictionary, aton):
-        for idx in dictionary:
-            if dictionary[idx][0] == aton:
-                return idx
-        return False
+        return address == self.network
 
     @classmethod
     def fmt_hwaddr(cls, b_hwaddr, hwaddr_len):
@@ -1,4 +1,5 @@
-import struct, io, socket
+import struct, socket
+from collections.abc import MutableMapping
 
 
 DHCPMagic = bytes(bytearray((0x63, 0x82, 0x53, 0x63)))
@@ -9,8 +10,75 @@ UInt32 = '!I'
 BOOTREQUEST = 1
 BOOTREPLY = 2
 
+# op .. file plus the magic cookie, options follow
+Header = struct.Struct('!BBBBIHH4s4s4s4s16s64s128s4s')
+
+SNAME = slice(44, 108)
+FILE = slice(108, 236)
+
+OPT_PAD = 0
+OPT_OVERLOAD = 52
+OPT_END = 255
+
+MAX_PACKET = 1500
+# rfc 3396 puts no bound on a concatenated option, nothing we read needs more than this
+MAX_OPTION = 512
+
+SERVER_NAME = bytes(socket.gethostname(), 'ascii')[:64].ljust(64, b'\x00')
+
+
+def encode(code, val):
+    # rfc 3396: long options are split into 255 byte chunks
+    if len(val) <= 255:
+        return bytes((code, len(val))) + val
+    return b''.join([bytes((code, len(val[idx:idx + 255]))) + val[idx:idx + 255] for idx in range(0, len(val), 255)])
+
+
+class Options(MutableMapping):
+    __slots__ = ('_raw', '_spans', '_data')
+
+    def __init__(self, raw=None, spans=None):
+        self._raw = raw
+        self._spans = spans if spans is not None else {}
+        self._data = {}
+
+    def __getitem__(self, code):
+        try:
+            return self._data[code]
+        except KeyError:
+            spans = self._spans.pop(code)
+
+        # rfc 3396: repeated instances of an option are concatenated
+        value = self._data[code] = b''.join([self._raw[start:end] for (start, end) in spans])
+        return value
+
+    def __setitem__(self, code, value):
+        self._spans.pop(code, None)
+        self._data[code] = value
+
+    def __delitem__(self, code):
+        if self._spans.pop(code, None) is None:
+            del self._data[code]
+        else:
+            self._data.pop(code, None)
+
+    def __contains__(self, code):
+        return code in self._data or code in self._spans
+
+    def __iter__(self):
+        yield from self._data
+        yield from list(self._spans)
+
+    def __len__(self):
+        return len(self._data) + len(self._spans)
+
 
 class Packet:
+    __slots__ = (
+        'op', 'htype', 'hlen', 'hops', 'xid', 'secs', 'flags',
+        'ciaddr', 'yiaddr', 'siaddr', 'giaddr', 'chaddr', 'sname', 'file', 'opts', 'block'
+    )
+
     def is_incoming(self):
         return BOOTREQUEST == self.op
 
@@ -19,10 +87,8 @@ class Packet:
 
     def get_dhcp_type(self):
         try:
-            return struct.unpack(UInt8, self.opts[53])[0]
-        except AttributeError:
-            return None
-        except KeyError:
+            return self.opts[53][0]
+        except (KeyError, IndexError):
             return None
 
     def __init__(self):
@@ -41,6 +107,7 @@ class Packet:
         self.sname = bytearray(64)
         self.file = bytearray(128)
         self.opts = {}
+        self.block = b''
 
     def reply(self):
         reply = Packet()
@@ -55,83 +122,115 @@ class Packet:
         reply.ciaddr = self.ciaddr
         reply.chaddr = self.chaddr
 
-        reply.sname = bytearray(socket.gethostname(), 'ascii').ljust(64, bytes(chr(0), 'ascii'))
+        reply.sname = SERVER_NAME
 
         return reply
 
     @classmethod
     def parse(cls, data: bytes):
-        # todo: eof, get/set
-        mypk = cls()
-        myio = io.BytesIO(data)
+        view = memoryview(data)
+        if len(view) < Header.size:
+            raise Truncated('%d bytes' % len(view))
 
-        mypk.op,        = struct.unpack(UInt8, myio.read(struct.calcsize(UInt8)))
-        mypk.htype,     = struct.unpack(UInt8, myio.read(struct.calcsize(UInt8)))
-        mypk.hlen,      = struct.unpack(UInt8, myio.read(struct.calcsize(UInt8)))
-        mypk.hops,      = struct.unpack(UInt8, myio.read(struct.calcsize(UInt8)))
+        mypk = cls.__new__(cls)
 
-        mypk.xid,       = struct.unpack(UInt32, myio.read(struct.calcsize(UInt32)))
+        (mypk.op, mypk.htype, mypk.hlen, mypk.hops, mypk.xid, mypk.secs, mypk.flags,
+         mypk.ciaddr, mypk.yiaddr, mypk.siaddr, mypk.giaddr, mypk.chaddr, mypk.sname, mypk.file,
+         magic) = Header.unpack_from(view)
 
-        mypk.secs,      = struct.unpack(UInt16, myio.read(struct.calcsize(UInt16)))
-        mypk.flags,     = struct.unpack(UInt16, myio.read(struct.calcsize(UInt16)))
-
-        myio.readinto(mypk.ciaddr)
-        myio.readinto(mypk.yiaddr)
-        myio.readinto(mypk.siaddr)
-        myio.readinto(mypk.giaddr)
-        myio.readinto(mypk.chaddr)
-        myio.readinto(mypk.sname)
-        myio.readinto(mypk.file)
-
-        magic = myio.read(4)
         if magic != DHCPMagic:
             raise InvalidMagic
 
-        while True:
-            opt_code, = struct.unpack(UInt8, myio.read(struct.calcsize(UInt8)))
-            if 0 == opt_code:
-                continue
-            if 255 == opt_code:
-                break
-            opt_len,  = struct.unpack(UInt8, myio.read(struct.calcsize(UInt8)))
-            mypk.opts[opt_code] = myio.read(opt_len)
+        spans = {}
+        cls._walk(view, Header.size, len(view), spans)
+
+        overload = spans.get(OPT_OVERLOAD)
+        if overload:
+            start, end = overload[0]
+            flag = view[start] if end > start else 0
+            # rfc 2131: file is read before sname
+            if flag & 1:
+                cls._walk(view, FILE.start, FILE.stop, spans)
+            if flag & 2:
+                cls._walk(view, SNAME.start, SNAME.stop, spans)
+
+        for (code, parts) in spans.items():
+            if sum(end - start for (start, end) in parts) > MAX_OPTION:
+                raise Oversized('option %d' % code)
+
+        mypk.opts = Options(view, spans)
+        mypk.block = b''
 
         return mypk
 
-    def pack(self):
+    @classmethod
+    def _walk(cls, view, pos, end, spans):
+        while pos < end:
+            opt_code = view[pos]
+            if OPT_PAD == opt_code:
+                pos += 1
+                continue
+            if OPT_END == opt_code:
+                return
+            if pos + 1 >= end:
+                raise Truncated('option %d at %d' % (opt_code, pos))
+            start = pos + 2
+            pos = start + view[pos + 1]
+            if pos > end:
+                raise Truncated('option %d at %d' % (opt_code, start - 2))
+            spans.setdefault(opt_code, []).append((start, pos))
+
+    def pack_into(self, buf, offset=0):
+        view = memoryview(buf)
+
+        Header.pack_into(
+            view, offset,
+            self.op, self.htype, self.hlen, self.hops, self.xid, self.secs, self.flags,
+            self.ciaddr, self.yiaddr, self.siaddr, self.giaddr, self.chaddr, self.sname, self.file,
+            DHCPMagic
+        )
+
+        pos = offset + Header.size
+        for code, val in self.opts.items():
+            pos = self._write(view, pos, encode(code, val))
 
-        myio = io.BytesIO()
+        # options encoded ahead of time by the middleware
+        pos = self._write(view, pos, self.block)
 
-        myio.write(struct.pack(UInt8,   self.op))
-        myio.write(struct.pack(UInt8,   self.htype))
-        myio.write(struct.pack(UInt8,   self.hlen))
-        myio.write(struct.pack(UInt8,   self.hops))
+        if pos >= len(view):
+            raise Overflow('%d bytes' % pos)
+        view[pos] = OPT_END
 
-        myio.write(struct.pack(UInt32,  self.xid))
+        return pos + 1
 
-        myio.write(struct.pack(UInt16,  self.secs))
-        myio.write(struct.pack(UInt16,  self.flags))
+    @classmethod
+    def _write(cls, view, pos, data):
+        end = pos + len(data)
+        if end > len(view):
+            raise Overflow('%d bytes' % end)
+        view[pos:end] = data
+        return end
 
-        myio.write(self.ciaddr)
-        myio.write(self.yiaddr)
-        myio.write(self.siaddr)
-        myio.write(self.giaddr)
-        myio.write(self.chaddr)
-        myio.write(self.sname)
-        myio.write(self.file)
+    def pack(self):
+        buf = bytearray(MAX_PACKET)
+        return bytes(buf[:self.pack_into(buf)])
 
-        myio.write(DHCPMagic)
 
-        for code, val in self.opts.items():
-            val_len = len(val)
-            myio.write(struct.pack(UInt8, code))
-            myio.write(struct.pack(UInt8, val_len))
-            myio.write(val)
+class MalformedPacket(Exception):
+    pass
+
+
+class InvalidMagic(MalformedPacket):
+    pass
+
 
-        myio.write(struct.pack(UInt8, 255))
+class Truncated(MalformedPacket):
+    pass
 
-        return myio.getvalue()
+
+class Oversized(MalformedPacket):
+    pass
 
 
-class InvalidMagic(Exception):
+class Overflow(Exception):
     pass
@@ -1,68 +1,106 @@
-import socket, traceback, logging
+import socket, traceback, logging, time
+from collections import Counter
 from dhns.mux import Server as BaseServer
-from dhns.dhcp.proto.packet import Packet
+from dhns.dhcp.proto.packet import Packet, MalformedPacket, Overflow, MAX_PACKET
 from dhns.dhcp import Handler
-from os import getenv
-
-
-IP_PKTINFO = 8
+from dhns.dhcp.throttle import Throttle
+import dhns.pktinfo as pktinfo
 
 
 class UdpServer(BaseServer):
-    def __init__(self, addr, handler: Handler):
+    def __init__(self, addr, handler: Handler, mac_rate=5, mac_burst=10, interface_rate=500, interface_burst=1000):
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self._sock.setsockopt(socket.SOL_IP, IP_PKTINFO, 1)
+        pktinfo.enable(self._sock)
         self._sock.bind(addr)
         self._handler = handler
         self._queue = []
+        self._buf = bytearray(MAX_PACKET)
+
+        self._macs = Throttle(mac_rate, mac_burst)
+        self._interfaces = Throttle(interface_rate, interface_burst)
+        self._inflight = set()
+        self.stats = Counter()
 
     def read(self):
-        buf, ancdata, _, addr = self._sock.recvmsg(512, socket.CMSG_SPACE(100))
-        interface = self._get_cmsg_to(ancdata)
+        buf, ancdata, _, addr = self._sock.recvmsg(MAX_PACKET, socket.CMSG_SPACE(100))
+        ifindex, interface = pktinfo.received(ancdata)
+        self.stats['received'] += 1
 
         try:
             query = Packet.parse(buf)
+        except MalformedPacket as e:
+            self.stats['malformed'] += 1
+            logging.info('dhcp: malformed packet from %s: %s', addr[0], repr(e))
+            return
+
+        if not self._admit(interface, query):
+            return
+
+        try:
             answer, pool = self._handler.handle(interface, query)
 
             if not pool:
                 return
 
-            if answer.is_broadcast():
+            if any(answer.giaddr):
+                logging.info('dhcp: got relayed from %s', socket.inet_ntoa(answer.giaddr))
+                addr = (socket.inet_ntoa(answer.giaddr), addr[1])
+            elif answer.is_broadcast():
                 logging.info('dhcp: got net broadcast on %s', interface)
-                self.broadcast(answer, interface, addr[1])
+                addr = ('255.255.255.255', addr[1])
             elif addr[0] == '0.0.0.0':
                 logging.info('dhcp: got adr broadcast on %s', interface)
                 addr = (socket.inet_ntoa(pool.broadcast), addr[1])
-                self._queue.append((addr, answer))
             else:
                 logging.info('dhcp: got unicast from %s', addr[0])
-                self._queue.append((addr, answer))
+
+            # reply from the address and interface the request came in on
+            key = self._key(query)
+            self._inflight.add(key)
+            self._queue.append((addr, answer, pktinfo.source(ifindex, interface), key))
         except Exception as e:
             traceback.print_exc()
 
     def write(self):
         if len(self._queue):
-            tup = self._queue.pop(0)
-            self._sock.sendto(tup[1].pack(), tup[0])
+            addr, answer, ancdata, key = self._queue.pop(0)
+            self._inflight.discard(key)
+            try:
+                size = answer.pack_into(self._buf)
+            except Overflow as e:
+                self.stats['dropped_overflow'] += 1
+                logging.info('dhcp: answer to %s does not fit: %s', addr[0], repr(e))
+                return
+            self._sock.sendmsg([memoryview(self._buf)[:size]], ancdata, 0, addr)
+            self.stats['answered'] += 1
 
     def wqlen(self):
         return len(self._queue)
 
+    def tick(self):
+        self._handler.tick()
+
     def fileno(self):
         return self._sock.fileno()
 
-    def _get_cmsg_to(self, ancdata):
-        for level, type, data in ancdata:
-            if level == socket.SOL_IP and type == IP_PKTINFO:
-                return socket.inet_ntoa(data[4:8])
-        return None
-
-    def broadcast(self, answer, addr, port):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        sock.bind((addr, int(getenv("DHCPPORT", 6767))))
-        sock.sendto(answer.pack(), ('255.255.255.255', port))
-        sock.close()
\ No newline at end of file
+    def _admit(self, interface, query):
+        # a copy of a request whose answer is still queued, relayed twice or read off several interfaces
+        if self._key(query) in self._inflight:
+            self.stats['dropped_retransmit'] += 1
+            return False
+
+        # check the client first, so a flooding client does not use up the interface budget
+        now = time.monotonic()
+        if not self._macs.allow(bytes(query.chaddr[:query.hlen]), now):
+            self.stats['dropped_mac'] += 1
+            return False
+        if not self._interfaces.allow(interface, now):
+            self.stats['dropped_interface'] += 1
+            return False
+
+        return True
+
+    def _key(self, query):
+        return bytes(query.chaddr[:query.hlen]), query.xid, query.get_dhcp_type()
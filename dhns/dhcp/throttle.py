@@ -0,0 +1,24 @@
+from cachetools import LRUCache
+
+
+class Throttle:
+    def __init__(self, rate, burst, size=65536):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = LRUCache(size)
+
+    def allow(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._buckets[key] = [self.burst - 1, now]
+            return True
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+
+        bucket[0] = tokens - 1
+        return True
@@ -1,25 +1,191 @@
-from dnslib import RR, DNSRecord, RDMAP, QTYPE
-from os import getenv
+from dnslib import RR, DNSRecord, DNSLabel, DNSQuestion, DNSBuffer, RDMAP, QTYPE, RCODE
+from cachetools import Cache, LRUCache
+from collections import Counter
+from dhns.dns.trie import Trie
+from dhns.dns.wire import Entry, Header, key as cache_key
+import threading, logging, time
+
+MAX_CHASE = 8
 
 
 class Middleware:
     def handle_dns_packet(self, query: DNSRecord, answer: DNSRecord):
         raise NotImplemented
 
+    def zones(self):
+        # matchGlob patterns this middleware can answer for, None for anything
+        return None
+
+    def bind(self, handler):
+        pass
+
+
+def plain(name):
+    return str(name).rstrip('.').lower()
+
+
+def question_wire(query: DNSRecord):
+    # the question section as the client sent it, dnslib keeps the case of every label
+    buf = DNSBuffer()
+    query.q.pack(buf)
+    return bytes(buf.data)
+
+
+class ResponseCache(LRUCache):
+    # name -> {(qtype, qclass): (entry, names)}, bounded by wire bytes; refs maps every
+    # name an answer mentions back to the cached names holding that answer
+    def __init__(self, maxsize):
+        super().__init__(maxsize, getsizeof=self.size)
+        self.refs = {}
+
+    def __setitem__(self, name, entries):
+        old = Cache.get(self, name)
+        super().__setitem__(name, entries)
+        if old is not None:
+            self._unlink(name, old)
+        self._link(name, entries)
+
+    def __delitem__(self, name):
+        entries = Cache.__getitem__(self, name)
+        super().__delitem__(name)
+        self._unlink(name, entries)
+
+    def referencing(self, name):
+        return list(self.refs.get(name, ()))
+
+    def _link(self, name, entries):
+        for (_, names) in entries.values():
+            for ref in names:
+                self.refs.setdefault(ref, set()).add(name)
+
+    def _unlink(self, name, entries):
+        for (_, names) in entries.values():
+            for ref in names:
+                holders = self.refs.get(ref)
+                if holders is not None:
+                    holders.discard(name)
+                    if not holders:
+                        del self.refs[ref]
+
+    @staticmethod
+    def size(entries):
+        return sum(len(entry.wire) for (entry, _) in entries.values())
+
 
 class Handler:
-    def __init__(self):
+    def __init__(self, cache_size=0):
         self.middleware = []
+        self._routes = Trie()
+
+        # front cache of local answers
+        self.cache = ResponseCache(cache_size) if cache_size else None
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._generation = 0
 
     def add_middleware(self, middleware: Middleware, priority):
         self.middleware.append((middleware, priority))
         self._sort()
+        self._index()
+        middleware.bind(self)
+
+    def route(self, qname):
+        return self._routes.lookup(qname)
 
     def handle(self, query: DNSRecord):
+        answer = self.respond(query)
+        if isinstance(answer, (bytes, bytearray)):
+            return DNSRecord.parse(answer)
+        return answer
+
+    def respond(self, query: DNSRecord):
+        if self.cache is None:
+            return self._chain(query)
+
+        name, qtype, qclass = cache_key(str(query.q.qname), query.q.qtype, query.q.qclass)
+        now = time.time()
+
+        with self._lock:
+            generation = self._generation
+        cached = self.lookup(name, qtype, qclass, query.header.id, query.header.rd, now, question_wire(query))
+        if cached is not None:
+            return cached
+        self.stats['miss'] += 1
+
+        answer = self._chain(query)
+
+        # packed answers come from middleware with a cache of its own
+        ttl = 0 if isinstance(answer, (bytes, bytearray)) else self.cache_ttl(answer)
+        if ttl > 0:
+            self.store(name, (qtype, qclass), Entry(answer.pack(), now, ttl), self.names(name, answer), generation)
+        return answer
+
+    def cached(self, question, buf):
+        # straight from a wire.Question, no DNSRecord is ever built for a hit
+        if self.cache is None or question.name is None:
+            return None
+        return self.lookup(question.name, question.qtype, question.qclass, question.id, question.rd, time.time(),
+                           bytes(buf[Header.size:question.end]))
+
+    def lookup(self, name, qtype, qclass, txid, rd, now, question=None):
+        with self._lock:
+            entry, _ = self.cache.get(name, {}).get((qtype, qclass), (None, None))
+        if entry is None or entry.expires <= now:
+            return None
+        self.stats['hit'] += 1
+        return entry.render(txid, rd, now, question)
+
+    def cache_ttl(self, answer: DNSRecord):
+        if answer.header.rcode == RCODE.NOERROR and answer.rr:
+            return min(rr.ttl for rr in answer.rr)
+
+        if answer.header.rcode in (RCODE.NOERROR, RCODE.NXDOMAIN):
+            for rr in answer.auth:
+                if rr.rtype == QTYPE.SOA:
+                    return min(rr.ttl, rr.rdata.times[-1])
+
+        return 0
+
+    def names(self, name, answer: DNSRecord):
+        # everything the answer depends on: its owners and the targets of any aliases in it
+        names = {name}
+        for rr in answer.rr + answer.auth:
+            names.add(plain(rr.rname))
+            if rr.rtype == QTYPE.CNAME:
+                names.add(plain(rr.rdata.label))
+        return frozenset(names)
+
+    def store(self, name, key, entry, names, generation):
+        with self._lock:
+            # an invalidation raced with this answer, it may already be stale
+            if generation != self._generation:
+                return
+            entries = dict(self.cache.get(name, {}))
+            entries[key] = (entry, names)
+            try:
+                self.cache[name] = entries
+            except ValueError:
+                pass
+
+    def invalidate(self, names):
+        with self._lock:
+            self._generation += 1
+            if self.cache is None:
+                return
+            for name in names:
+                for holder in self.cache.referencing(plain(DNSLabel(name))):
+                    if self.cache.pop(holder, None) is not None:
+                        self.stats['invalidated'] += 1
+
+    def _chain(self, query: DNSRecord):
         answer = query.reply()
 
-        for middleware in self.middleware:
-            if middleware[0].handle_dns_packet(query, answer):
+        for middleware in self.route(query.q.qname):
+            result = middleware.handle_dns_packet(query, answer)
+            # middleware may answer with a ready made wire packet
+            if isinstance(result, (bytes, bytearray)):
+                return result
+            if result:
                 break
 
         return answer
@@ -27,6 +193,18 @@ class Handler:
     def _sort(self):
         self.middleware.sort(key=lambda tup: tup[1], reverse=True)
 
+    def _index(self):
+        # inserted by priority, so lookups come back in chain order
+        routes = Trie()
+        for (middleware, _) in self.middleware:
+            zones = middleware.zones()
+            if zones is None:
+                routes.add(None, middleware)
+            else:
+                for zone in zones:
+                    routes.add(zone, middleware)
+        self._routes = routes
+
 
 class SrvHandler(Middleware):
     def __init__(self, glob='*', address=None, port=53):
@@ -34,6 +212,9 @@ class SrvHandler(Middleware):
         self.address = address
         self.port = port
 
+    def zones(self):
+        return [self.glob]
+
     def handle_dns_packet(self, query: DNSRecord, answer: DNSRecord):
         if query.q.qname.matchGlob(self.glob):
             try:
@@ -50,6 +231,18 @@ class SrvHandler(Middleware):
 class FixHandler(Middleware):
     def __init__(self, records):
         self.records = records
+        self.index = Trie()
+        for rec in records:
+            self.index.add(rec[0], rec)
+
+        self.handler = None
+        self._chase = threading.local()
+
+    def zones(self):
+        return [rec[0] for rec in self.records]
+
+    def bind(self, handler):
+        self.handler = handler
 
     def handle_dns_packet(self, query: DNSRecord, answer: DNSRecord):
         import random
@@ -59,31 +252,67 @@ class FixHandler(Middleware):
         found = False
 
         records = []
+        aliases = []
 
-        for rec in self.records:
-            if qname.matchGlob(rec[0]):
-                found = True
-                if qtype == QTYPE.A and rec[1] == QTYPE.CNAME:
-                    # self-resolve it as A additionally
-                    local_q = DNSRecord.question(rec[2], "A")
-                    local_a = DNSRecord.parse(local_q.send('localhost', port=int(getenv("DNSPORT", 5353)), timeout=1.0))
-
-                    for rr in local_a.rr:
-                        records.append((
-                            qname,
-                            rr.rtype,
-                            str(rr.rdata)
-                        ))
-
-                    # records.append((qname, rec[1], rec[2]))
-                if qtype == QTYPE.ANY:
-                    records.append(rec)
-                elif qtype == rec[1]:
-                    records.append(rec)
+        for rec in self.index.lookup(qname):
+            found = True
+            if rec[1] == QTYPE.CNAME and qtype not in (QTYPE.CNAME, QTYPE.ANY):
+                aliases.append(rec)
+            elif qtype == QTYPE.ANY:
+                records.append(rec)
+            elif qtype == rec[1]:
+                records.append(rec)
 
         random.shuffle(records)
 
         for rec in records:
-            answer.add_answer(RR(rname=rec[0], rtype=rec[1], ttl=60, rdata=RDMAP.get(QTYPE.get(rec[1]))(rec[2])))
+            answer.add_answer(self.rr(qname, rec))
+
+        # the alias goes first, followed by whatever its target resolves to
+        for rec in aliases:
+            answer.add_answer(self.rr(qname, rec))
+            chased = self.chase(qname, rec[2], qtype)
+            if chased is None:
+                continue
+            for rr in chased.rr:
+                answer.add_answer(rr)
+            # rfc 6604: the rcode is the one of the last name in the chain
+            if chased.header.rcode != RCODE.NOERROR:
+                answer.header.rcode = chased.header.rcode
+            if chased.header.rcode != RCODE.NOERROR or not chased.rr:
+                for rr in chased.auth:
+                    answer.add_auth(rr)
 
         return found
+
+    def rr(self, qname, rec):
+        return RR(rname=qname, rtype=rec[1], ttl=60, rdata=RDMAP.get(QTYPE.get(rec[1]))(rec[2]))
+
+    def chase(self, qname, target, qtype):
+        if self.handler is None:
+            return None
+
+        # one chase state per request, shared by every nested lookup it makes
+        state = getattr(self._chase, 'state', None)
+        owner = state is None
+        if owner:
+            state = self._chase.state = ({}, [(str(qname).lower(), qtype)])
+        memo, path = state
+
+        try:
+            key = (str(target).rstrip('.').lower() + '.', qtype)
+            if key in memo:
+                return memo[key]
+            if key in path or len(path) > MAX_CHASE:
+                logging.info('dns: not following %s to %s, loop or chain too long', qname, target)
+                return None
+
+            path.append(key)
+            try:
+                memo[key] = self.handler.handle(DNSRecord(q=DNSQuestion(target, qtype)))
+            finally:
+                path.pop()
+            return memo[key]
+        finally:
+            if owner:
+                del self._chase.state
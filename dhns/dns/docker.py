@@ -1,12 +1,20 @@
 from typeguard import typechecked
-from collections import namedtuple
-from dnslib import DNSLabel, DNSRecord, QTYPE, RR, RDMAP
+from collections import namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor
+from dnslib import DNSLabel, DNSRecord, QTYPE, RR, RDMAP, SOA
 from dhns.dns import Middleware
-import threading, re, json, logging
+import threading, ipaddress, re, json, logging, time, copy
 
 Container = namedtuple('Container', 'id, name, state, addrs')
 RE_VALIDNAME = re.compile('[^\w\d.-]')
 
+# how long a known name without records of the asked type may be cached as such
+NEGATIVE_TTL = 60
+
+
+def reverse_pointer(addr):
+    return ipaddress.ip_address(addr).reverse_pointer
+
 
 def get(d, *keys):
     from functools import reduce
@@ -15,89 +23,238 @@ def get(d, *keys):
 
 
 class Storage:
-    def __init__(self):
-        self._data = {}
-        self._lock = self._lock = threading.Lock()
+    def __init__(self, ttl=60, on_change=None):
+        self._containers = {}
+        self._names = {}
+        self._reverse = {}
+        self._lock = threading.Lock()
+        self._ttl = ttl
+        self._on_change = on_change
+
+        # readers only ever see a finished dict, writers copy and swap it
+        self._snapshot = {}
 
     @typechecked
-    def append(self, key:str, val:list):
-        logging.info("+ %s %s" % (key, val))
+    def set(self, cid:str, names:list, addrs:list):
+        names = tuple(name.lower() for name in names)
+        addrs = tuple(addrs)
         with self._lock:
-            try:
-                self._data[key]['ref'] += 1
-                self._data[key]['adr'].extend(val)
-            except KeyError:
-                self._data[key] = {'ref': 1, 'adr': val}
+            if self._containers.get(cid) == (names, addrs):
+                return
+            touched = self._unlink(cid)
+            self._containers[cid] = (names, addrs)
+            for name in names:
+                logging.info("+ %s %s" % (name, list(addrs)))
+                self._names.setdefault(name, {})[cid] = addrs
+                touched.add(name)
+            for addr in addrs:
+                pointer = reverse_pointer(addr)
+                self._reverse.setdefault(pointer, {})[cid] = names
+                touched.add(pointer)
+            self._publish(touched)
 
     @typechecked
-    def remove(self, key:str):
+    def discard(self, cid:str):
         with self._lock:
-            try:
-                if self._data[key]['ref'] == 1:
-                    logging.info("D %s" % key)
-                    self._data.pop(key)
-                else:
-                    logging.info("- %s" % key)
-                    self._data[key]['ref'] -= 1
-            except KeyError:
-                pass
-        pass
+            touched = self._unlink(cid)
+            self._publish(touched)
 
-    @typechecked
-    def query(self, key:str) -> list :
+    def __contains__(self, cid):
+        return cid in self._containers
+
+    def containers(self):
         with self._lock:
-            try:
-                return self._data[key]['adr']
-            except KeyError:
-                return []
+            return dict(self._containers)
+
+    def query(self, key, qtype):
+        # None for names we do not know, an empty tuple for names without records of that type
+        records = self._snapshot.get(key)
+        if records is None:
+            return None
+        return records.get(qtype, ())
+
+    def _unlink(self, cid):
+        names, addrs = self._containers.pop(cid, ((), ()))
+        for name in names:
+            owners = self._names.get(name, {})
+            owners.pop(cid, None)
+            if not owners:
+                logging.info("D %s" % name)
+                self._names.pop(name, None)
+            else:
+                logging.info("- %s" % name)
+
+        pointers = [reverse_pointer(addr) for addr in addrs]
+        for pointer in pointers:
+            owners = self._reverse.get(pointer, {})
+            owners.pop(cid, None)
+            if not owners:
+                self._reverse.pop(pointer, None)
+
+        return set(names).union(pointers)
+
+    def _publish(self, keys):
+        if not keys:
+            return
+
+        snapshot = dict(self._snapshot)
+        for key in keys:
+            if key in self._names:
+                addrs = [addr for addrs in self._names[key].values() for addr in addrs]
+                records = {
+                    QTYPE.A: self._records(key, QTYPE.A, [addr for addr in addrs if ':' not in addr]),
+                    QTYPE.AAAA: self._records(key, QTYPE.AAAA, [addr for addr in addrs if ':' in addr]),
+                }
+            elif key in self._reverse:
+                records = {
+                    QTYPE.PTR: self._records(key, QTYPE.PTR, [name for names in self._reverse[key].values() for name in names]),
+                }
+            else:
+                snapshot.pop(key, None)
+                continue
+
+            records[QTYPE.ANY] = sum(records.values(), ())
+            snapshot[key] = records
+
+        self._snapshot = snapshot
+
+        if self._on_change is not None:
+            self._on_change(keys)
+
+    def _records(self, key, qtype, values):
+        rdata = RDMAP[QTYPE[qtype]]
+        return tuple(RR(rname=key, rtype=qtype, ttl=self._ttl, rdata=rdata(value)) for value in values)
 
 
 class Resolver(Middleware):
-    def __init__(self, docker='unix:///var/run/docker.sock', domain='docker'):
+    def __init__(self, docker='unix:///var/run/docker.sock', domain='docker', workers=8, reconcile=60):
         from docker.client import DockerClient
 
         self._docker = DockerClient(docker, version='auto')
         self._domain = domain
 
-        self._storage = Storage()
+        self._handler = None
+        self._storage = Storage(on_change=self.invalidate)
         self._lock = threading.Lock()
+        # both only hold containers that are stored or still being inspected
+        self._generation = Counter()
+        self._syncing = Counter()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._reconcile = reconcile
 
         threading.Thread(group=None, target=self.listen).start()
 
+    def bind(self, handler):
+        self._handler = handler
+
+    def invalidate(self, names):
+        if self._handler is not None:
+            self._handler.invalidate(names)
+
     def listen(self):
         self.running = True
 
-        events = self._docker.events()
+        # subscribe first, so nothing that happens during the initial sync is lost
+        events = self._docker.events(filters={'type': ['container', 'network']})
 
-        for container in self._docker.containers.list():
-            for rec in self._inspect(container):
-                self._storage.append(rec.name, rec.addrs)
+        for future in [self.submit(summary['Id']) for summary in self._docker.api.containers()]:
+            future.result()
+
+        if self._reconcile:
+            threading.Thread(group=None, target=self.reconcile, daemon=True).start()
 
         for raw in events:
             if not self.running:
                 break
 
             evt = json.loads(raw)
-            if evt.get('Type', 'container') != 'container':
+            action = evt.get('Action') or evt.get('status')
+            attributes = get(evt, 'Actor', 'Attributes') or {}
+
+            if evt.get('Type', 'container') == 'network':
+                cid = attributes.get('container')
+                if cid and action in {'connect', 'disconnect'}:
+                    self.submit(cid)
                 continue
 
-            cid = evt.get('id')
+            cid = evt.get('id') or get(evt, 'Actor', 'ID')
             if cid is None:
                 continue
 
-            status = evt.get('status')
-            if status in {'start', 'die'}:
-                container = self._docker.containers.get(cid)
-                for rec in self._inspect(container):
-                    if status == 'start':
-                        self._storage.append(rec.name, rec.addrs)
-                    else:
-                        self._storage.remove(rec.name)
+            if action == 'die':
+                # nothing to ask docker about, the container is gone from dns right away
+                self.drop(cid)
+            elif action in {'start', 'rename'}:
+                self.submit(cid)
+
+    def submit(self, cid):
+        with self._lock:
+            self._generation[cid] += 1
+            self._syncing[cid] += 1
+            generation = self._generation[cid]
+        return self._pool.submit(self.sync, cid, generation)
+
+    def drop(self, cid):
+        # any inspect still in flight for this container is outdated now
+        with self._lock:
+            self._generation[cid] += 1
+            self._storage.discard(cid)
+            self._forget(cid)
+
+    def sync(self, cid, generation):
+        try:
+            container = self._docker.containers.get(cid)
+            recs = self._inspect(container)
+        except Exception as e:
+            logging.info('docker: inspect of %s failed: %r', cid[:12], e)
+            recs = []
+
+        with self._lock:
+            self._syncing[cid] -= 1
+            # a newer event for this container already took over
+            if self._generation[cid] == generation:
+                if recs and recs[0].state:
+                    self._storage.set(cid, [rec.name for rec in recs], recs[0].addrs)
+                else:
+                    self._storage.discard(cid)
+            self._forget(cid)
+
+    def reconcile(self):
+        while self.running:
+            time.sleep(self._reconcile)
+            try:
+                self.reconcile_once()
+            except Exception:
+                logging.exception('docker: reconciliation failed')
+
+    def reconcile_once(self):
+        # one list call carries ids and addresses, only containers that drifted get inspected;
+        # what we know is taken first, anything stored after that is newer than the list
+        known = self._storage.containers()
+        running = {}
+        for summary in self._docker.api.containers():
+            running[summary['Id']] = tuple(self._get_addrs(get(summary, 'NetworkSettings', 'Networks')))
+
+        for cid in known.keys() - running.keys():
+            logging.info('docker: reconcile dropped %s', cid[:12])
+            self.drop(cid)
+        for cid, addrs in running.items():
+            if cid not in known or set(known[cid][1]) != set(addrs):
+                logging.info('docker: reconcile refreshing %s', cid[:12])
+                self.submit(cid)
+
+    def _forget(self, cid):
+        # with no inspect left to outdate, a container that is gone needs no generation
+        if self._syncing[cid] > 0:
+            return
+        self._syncing.pop(cid, None)
+        if cid not in self._storage:
+            self._generation.pop(cid, None)
 
     def _inspect(self, container):
         name = get(container.attrs, 'Name')
         if not container.name:
-            return None
+            return []
 
         id = get(container.attrs, 'Id')
         labels = get(container.attrs, 'Config', 'Labels')
@@ -109,7 +266,8 @@ class Resolver(Middleware):
         return [ Container(id, name, state, ip_addrs) for name in self._get_names(name, labels) ]
 
     def _get_addrs(self, networks):
-        return list(filter(None, [value['IPAddress'] for value in networks.values()]))
+        networks = (networks or {}).values()
+        return list(filter(None, [value.get(key) for key in ('IPAddress', 'GlobalIPv6Address') for value in networks]))
 
     def _get_names(self, name, labels):
         names = [ RE_VALIDNAME.sub('', name).rstrip('.') ]
@@ -134,18 +292,25 @@ class Resolver(Middleware):
         return names
 
     def handle_dns_packet(self, query: DNSRecord, answer: DNSRecord):
-        addrs = []
-
-        if query.q.qtype in (QTYPE.A, QTYPE.ANY):
-            addrs = self._storage.query(
-                str(query.q.qname).rstrip('.')
-            )
+        records = self._storage.query(str(query.q.qname).rstrip('.').lower(), query.q.qtype)
+        if records is None:
+            return
 
-        if len(addrs):
-            for addr in addrs:
-                answer.add_answer(
-                    RR(rname=query.q.qname, rtype=QTYPE.A, ttl=60, rdata=RDMAP["A"](addr))
-                )
+        answer.header.aa = 1
 
+        # a known name without records of the asked type is still ours to answer
+        if not records:
+            zone = DNSLabel(self._domain) if query.q.qname.matchSuffix(self._domain) else query.q.qname
+            answer.add_auth(self.get_soa(zone))
             return self
 
+        # owners are prebuilt lowercase and take the spelling of the question on the way out
+        for record in records:
+            record = copy.copy(record)
+            record.rname = query.q.qname
+            answer.add_answer(record)
+        return self
+
+    def get_soa(self, zone):
+        times = (int(time.time()), 3600, 600, 86400, NEGATIVE_TTL)
+        return RR(rname=zone, rtype=QTYPE.SOA, ttl=NEGATIVE_TTL, rdata=SOA(zone.add('ns'), zone.add('hostmaster'), times))
@@ -0,0 +1,230 @@
+import asyncio, secrets, threading, logging
+from collections import Counter
+from dnslib import DNSRecord, DNSHeader, EDNS0, QTYPE
+from dhns.dns.wire import EDNS_PAYLOAD
+
+# queries sent from one source port before moving to a fresh one, so a spoofer cannot
+# learn the port once and then only has the txid left to guess
+ROTATE_AFTER = 1000
+
+
+class Upstream:
+    __slots__ = ('addr', 'srtt', 'failures', 'retry_at')
+
+    def __init__(self, addr):
+        if isinstance(addr, str):
+            host, _, port = addr.partition(':')
+            addr = (host, int(port or 53))
+
+        self.addr = tuple(addr)
+        self.srtt = None
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def healthy(self, now):
+        return self.retry_at <= now
+
+    def observe(self, rtt):
+        self.srtt = rtt if self.srtt is None else self.srtt + (rtt - self.srtt) / 8
+
+    def success(self, rtt):
+        self.observe(rtt)
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def failure(self, now, backoff, backoff_max):
+        self.failures += 1
+        self.retry_at = now + min(backoff_max, backoff * 2 ** (self.failures - 1))
+
+
+class Forwarder(asyncio.DatagramProtocol):
+    def __init__(self, upstreams, timeout=5.0, hedge=0.05, backoff=1.0, backoff_max=60.0):
+        self.upstreams = [Upstream(addr) for addr in upstreams]
+        self.timeout = timeout
+        self.hedge = hedge
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.stats = Counter()
+
+        self._pending = {}
+        self._inflight = {}
+        self._transport = None
+        self._sent = 0
+        self._rotating = False
+
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        threading.Thread(target=self._run, args=(ready,), daemon=True).start()
+        ready.wait()
+
+    def query(self, query: DNSRecord) -> DNSRecord:
+        return self.submit(query).result(self.timeout * len(self.upstreams) + 1)
+
+    def submit(self, query: DNSRecord):
+        return asyncio.run_coroutine_threadsafe(self.resolve(query.q), self._loop)
+
+    async def resolve(self, question):
+        key = (str(question.qname).lower(), question.qclass, question.qtype)
+
+        shared = self._inflight.get(key)
+        if shared is None:
+            self.stats['upstream'] += 1
+            shared = self._inflight[key] = self._loop.create_task(self._forward(question))
+            shared.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.stats['coalesced'] += 1
+
+        # one waiter giving up must not cancel the upstream query for the others
+        return await asyncio.shield(shared)
+
+    def metrics(self):
+        now = self._loop.time()
+        return [
+            {'upstream': '%s:%d' % upstream.addr, 'srtt': upstream.srtt,
+             'failures': upstream.failures, 'healthy': upstream.healthy(now)}
+            for upstream in self.upstreams
+        ]
+
+    def order(self, now):
+        # fastest healthy first, failing upstreams only as a last resort
+        healthy = [upstream for upstream in self.upstreams if upstream.healthy(now)]
+        failing = [upstream for upstream in self.upstreams if not upstream.healthy(now)]
+        healthy.sort(key=lambda upstream: 0.0 if upstream.srtt is None else upstream.srtt)
+        failing.sort(key=lambda upstream: upstream.retry_at)
+        return healthy + failing
+
+    async def _forward(self, question):
+        order = self.order(self._loop.time())
+        attempts, launched, error = set(), 0, None
+
+        while attempts or launched < len(order):
+            if not attempts:
+                attempts.add(self._loop.create_task(self._attempt(order[launched], question)))
+                launched += 1
+
+            # race the runner-up once the best upstream is slower than expected
+            hedge = self.hedge is not None and launched == 1 < len(order)
+            delay = max(self.hedge, 2 * (order[0].srtt or 0)) if hedge else None
+
+            done, attempts = await asyncio.wait(attempts, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                self.stats['hedged'] += 1
+                attempts.add(self._loop.create_task(self._attempt(order[launched], question)))
+                launched += 1
+                continue
+
+            for attempt in done:
+                if attempt.exception() is None:
+                    for other in attempts:
+                        other.cancel()
+                    return attempt.result()
+                error = attempt.exception()
+
+        raise Unreachable(str(question.qname)) from error
+
+    async def _attempt(self, upstream, question):
+        started = self._loop.time()
+        try:
+            res = await self._exchange(upstream.addr, question, self.timeout)
+            if res.header.tc:
+                self.stats['tcp'] += 1
+                res = await self._exchange_tcp(upstream.addr, question, self.timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError) as e:
+            self.stats['failed'] += 1
+            upstream.failure(self._loop.time(), self.backoff, self.backoff_max)
+            logging.info('dns: upstream %s:%d failed for %s: %r', upstream.addr[0], upstream.addr[1], question.qname, e)
+            raise
+        except asyncio.CancelledError:
+            # lost a hedged race, so it is at least this slow
+            upstream.observe(self._loop.time() - started)
+            raise
+        upstream.success(self._loop.time() - started)
+        return res
+
+    async def _exchange(self, upstream, question, timeout):
+        # the txid is all a spoofed answer has to guess besides the port, so it comes from the os
+        txid = secrets.randbits(16)
+        while (txid, upstream) in self._pending:
+            txid = secrets.randbits(16)
+
+        future = self._loop.create_future()
+        self._pending[(txid, upstream)] = (future, question)
+        try:
+            self._transport.sendto(self._request(txid, question).pack(), upstream)
+            self._sent += 1
+            if self._sent >= ROTATE_AFTER and not self._rotating:
+                self._rotating = True
+                self._loop.create_task(self._rotate())
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop((txid, upstream), None)
+
+    async def _exchange_tcp(self, upstream, question, timeout):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*upstream), timeout)
+        try:
+            data = self._request(secrets.randbits(16), question).pack()
+            writer.write(len(data).to_bytes(2, 'big') + data)
+
+            size = int.from_bytes(await asyncio.wait_for(reader.readexactly(2), timeout), 'big')
+            return self._strip(DNSRecord.parse(await asyncio.wait_for(reader.readexactly(size), timeout)))
+        finally:
+            writer.close()
+
+    async def _rotate(self):
+        try:
+            transport, _ = await self._loop.create_datagram_endpoint(lambda: self, local_addr=('0.0.0.0', 0))
+        except OSError as e:
+            logging.info('dns: forwarder could not move to a new port: %r', e)
+        else:
+            # answers to queries already sent still arrive on the old port until they time out
+            old, self._transport = self._transport, transport
+            self._loop.call_later(self.timeout, old.close)
+            self.stats['rotated'] += 1
+        finally:
+            self._sent = 0
+            self._rotating = False
+
+    def _request(self, txid, question):
+        return DNSRecord(DNSHeader(id=txid, rd=1), q=question, ar=[EDNS0(udp_len=EDNS_PAYLOAD)])
+
+    def _strip(self, res):
+        # edns is hop by hop, our own listeners add their opt record
+        res.ar = [rr for rr in res.ar if rr.rtype != QTYPE.OPT]
+        return res
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+
+        entry = self._pending.get((int.from_bytes(data[:2], 'big'), addr))
+        if entry is None or entry[0].done():
+            self.stats['unexpected'] += 1
+            return
+
+        future, question = entry
+        try:
+            res = DNSRecord.parse(data)
+        except Exception:
+            self.stats['malformed'] += 1
+            return
+
+        if res.q.qname != question.qname or res.q.qtype != question.qtype or res.q.qclass != question.qclass:
+            self.stats['unexpected'] += 1
+            return
+
+        future.set_result(self._strip(res))
+
+    def error_received(self, exc):
+        logging.info('dns: forwarder socket error: %r', exc)
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self._loop)
+        self._transport, _ = self._loop.run_until_complete(
+            self._loop.create_datagram_endpoint(lambda: self, local_addr=('0.0.0.0', 0))
+        )
+        ready.set()
+        self._loop.run_forever()
+
+
+class Unreachable(Exception):
+    pass
@@ -1,53 +1,133 @@
-from dnslib import DNSRecord
+from dnslib import DNSRecord, QTYPE, RCODE
 from cachetools import LRUCache
-from dhns.dns import Middleware
-import time, traceback
+from collections import Counter
+from dhns.dns import Middleware, question_wire
+from dhns.dns.forwarder import Forwarder, Unreachable
+from dhns.dns.wire import Entry, key as cache_key
+import threading, time, traceback, logging
 
 
 class Resolver(Middleware):
-    def __init__(self):
-        self.resolvers = [
+    def __init__(self, upstreams=None, timeout=5, hedge=0.05, negative_ttl=3600, servfail_ttl=0,
+                 prefetch=0.1, prefetch_hits=3, stale_ttl=0):
+        self.resolvers = upstreams or [
             ("8.8.8.8", 53),
             ("8.8.4.4", 53)
         ]
+        # workers and the forwarder's loop thread share it, and an lru get reorders the cache
         self.cache = LRUCache(64000)
+        self._lock = threading.Lock()
+        self.forwarder = Forwarder(self.resolvers, timeout=timeout, hedge=hedge)
+        self.negative_ttl = negative_ttl
+        self.servfail_ttl = servfail_ttl
+        self.prefetch = prefetch
+        self.prefetch_hits = prefetch_hits
+        self.stale_ttl = stale_ttl
+        self.refreshing = set()
+        self.stats = Counter()
 
     def handle_dns_packet(self, query: DNSRecord, answer: DNSRecord):
-        key = "%s/%d/%d" % (query.q.qname, query.q.qclass, query.q.qtype)
+        key = cache_key(str(query.q.qname), query.q.qtype, query.q.qclass)
+        now = time.time()
+
+        with self._lock:
+            entry = self.cache.get(key)
+        if entry is not None:
+            if entry.expires > now:
+                self.stats['hit_%s' % entry.kind] += 1
+                entry.touch(now)
+                self.refresh(key, entry, query, now)
+                return entry.render(query.header.id, query.header.rd, now, question_wire(query))
+            self.stats['expired'] += 1
+        self.stats['miss'] += 1
+
+        try:
+            res = self.forwarder.query(query)
+            kind, ttl = self.classify(res)
+            if kind == 'servfail' and self.is_stale(entry, now):
+                return self.from_stale(entry, query)
+            if ttl <= 0:
+                return self.from_res(res, answer)
+            return self.store(key, res, now, entry).render(query.header.id, query.header.rd, now, question_wire(query))
+        except Unreachable as e:
+            logging.info('dns: no upstream answered %s', e)
+        except:
+            traceback.print_exc()
+
+        if self.is_stale(entry, now):
+            return self.from_stale(entry, query)
+
+    def refresh(self, key, entry, query, now):
+        # only entries that keep being asked for are worth an upstream query ahead of time
+        if entry.hits < self.prefetch_hits:
+            return
+        if entry.expires - now > (entry.expires - entry.stored) * self.prefetch:
+            return
 
-        if key in self.cache:
-            received, cached = self.cache[key]
-            if not self.is_expired(received, cached):
-                return self.from_cache(key, answer)
+        with self._lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        self.stats['prefetch'] += 1
 
-        for resolver in self.resolvers:
+        def done(future):
+            with self._lock:
+                self.refreshing.discard(key)
             try:
-                res = DNSRecord.parse(query.send(resolver[0], resolver[1], timeout=5))
-                if 0 == len(res.rr) or res.header.rcode:
-                    return self.from_res(res, answer)
-                else:
-                    self.cache[key] = (time.time(), res)
-                    return self.from_cache(key, answer)
-            except:
-                traceback.print_exc()
-
-    def is_expired(self, cached, answer):
-        now = time.time()
-        for rr in answer.rr:
-            if cached + rr.ttl < now:
-                return True
-        return False
+                res = future.result()
+            except Exception as e:
+                logging.info('dns: prefetch of %s failed: %r', key[0], e)
+                return
+            # a prefetch may renew an answer or improve on it, never trade it for a failure
+            kind, ttl = self.classify(res)
+            if ttl > 0 and kind in ('positive', entry.kind):
+                self.store(key, res, time.time(), entry)
 
-    def from_cache(self, key, answer):
-        now = time.time(); cached, res = self.cache[key]
-        for rr in res.rr:
-            rr.ttl -= int(now - cached)
-            answer.add_answer(rr)
-        answer.header.rcode = res.header.rcode
-        return True
+        self.forwarder.submit(query).add_done_callback(done)
+
+    def store(self, key, res, now, previous=None):
+        kind, ttl = self.classify(res)
+        self.stats['stored_%s' % kind] += 1
+
+        entry = Entry(res.pack(), now, ttl, kind)
+        with self._lock:
+            self.cache[key] = entry
+        # popularity carries over unless the old answer sat unused for a whole ttl
+        if previous is not None and now - previous.last < previous.expires - previous.stored:
+            entry.hits = previous.hits
+        return entry
+
+    def is_stale(self, entry, now):
+        return entry is not None and entry.expires + self.stale_ttl > now
+
+    def from_stale(self, entry, query):
+        # rfc 8767: better a slightly old answer than none while upstreams are down
+        self.stats['stale_%s' % entry.kind] += 1
+        return entry.render_stale(query.header.id, query.header.rd, question=question_wire(query))
+
+    def classify(self, res):
+        rcode = res.header.rcode
+
+        if rcode == RCODE.NOERROR and len(res.rr):
+            return 'positive', min(rr.ttl for rr in res.rr)
+
+        if rcode in (RCODE.NOERROR, RCODE.NXDOMAIN):
+            # rfc 2308: negative answers live as long as the soa minimum, never without one
+            kind = 'nxdomain' if rcode == RCODE.NXDOMAIN else 'nodata'
+            for rr in res.auth:
+                if rr.rtype == QTYPE.SOA:
+                    return kind, min(rr.ttl, rr.rdata.times[-1], self.negative_ttl)
+            return kind, 0
+
+        if rcode == RCODE.SERVFAIL:
+            return 'servfail', self.servfail_ttl
+
+        return 'other', 0
 
     def from_res(self, res, answer):
         for rr in res.rr:
             answer.add_answer(rr)
+        for rr in res.auth:
+            answer.add_auth(rr)
         answer.header.rcode = res.header.rcode
         return True
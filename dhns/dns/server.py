@@ -1,29 +1,80 @@
-import socket, traceback, threading, logging
-from dnslib import DNSRecord
+import socket, traceback, threading, logging, time
+from collections import Counter
+from dnslib import DNSRecord, RCODE, QTYPE
 from dhns.mux import Server as MuxServer
 from dhns.dns import Handler
+from dhns.workers import Workers
+import dhns.dns.wire as wire
+import dhns.pktinfo as pktinfo
 
+OVERLOAD_DROP = 'drop'
+OVERLOAD_SERVFAIL = 'servfail'
 
-IP_PKTINFO = 8
+RECV_SIZE = 4096
+
+
+def resolve(handler: Handler, query: DNSRecord, limit):
+    answer = handler.respond(query)
+    if not isinstance(answer, (bytes, bytearray)):
+        answer = answer.pack()
+    return finish(answer, edns_payload(query), limit)
+
+
+def finish(answer, payload, limit):
+    if payload is None:
+        return wire.truncate(answer, limit)
+
+    # rfc 6891: answer edns with edns, and never exceed what either side can take
+    limit = max(limit, min(payload, wire.EDNS_PAYLOAD)) - wire.Opt.size
+    return wire.add_opt(wire.truncate(answer, limit), wire.EDNS_PAYLOAD)
+
+
+def edns_payload(query: DNSRecord):
+    for rr in query.ar:
+        if rr.rtype == QTYPE.OPT:
+            return max(wire.MAX_UDP, rr.rclass)
+    return None
 
 
 class UdpServer(MuxServer):
-    def __init__(self, addr, handler: Handler):
+    def __init__(self, addr, handler: Handler, workers=16, queue_size=1024, overload=OVERLOAD_SERVFAIL):
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._sock.setsockopt(socket.SOL_IP, IP_PKTINFO, 1)
+        pktinfo.enable(self._sock)
         self._sock.bind(addr)
         self._handler = handler
         self._queue = []
+        self._overload = overload
 
-        _, self._port = addr
+        # workers=0 keeps the old thread per query behaviour
+        self.workers = Workers(self.process, workers, queue_size) if workers else None
+        self.stats = Counter()
 
     def read(self):
-        buf, ancdata, _, addr = self._sock.recvmsg(512, socket.CMSG_SPACE(100))
-        respond = self._get_cmsg_to(ancdata).encode('utf8')
+        buf, ancdata, _, addr = self._sock.recvmsg(RECV_SIZE, socket.CMSG_SPACE(100))
+        self.stats['received'] += 1
+
+        # junk never gets as far as a worker
+        try:
+            question = wire.parse_question(buf)
+        except wire.MalformedMessage:
+            self.stats['malformed'] += 1
+            return
 
-        thread = threading.Thread(group=None, target=self.process, args=(buf, addr, respond))
-        thread.start()
+        _, local = pktinfo.received(ancdata)
+        respond = pktinfo.source(0, local)
+
+        answer = self._handler.cached(question, buf)
+        if answer is not None:
+            self.stats['cached'] += 1
+            self._sock.sendmsg([finish(answer, question.payload, wire.MAX_UDP)], respond, 0, addr)
+            return
+
+        if self.workers is None:
+            thread = threading.Thread(group=None, target=self.process, args=(buf, addr, respond))
+            thread.start()
+        elif not self.workers.submit(buf, addr, respond):
+            self.overload(buf, question, addr, respond)
 
     def write(self):
         if len(self._queue):
@@ -36,24 +87,199 @@ class UdpServer(MuxServer):
     def fileno(self):
         return self._sock.fileno()
 
-    def _get_cmsg_to(self, ancdata):
-        for level, type, data in ancdata:
-            if level == socket.SOL_IP and type == IP_PKTINFO:
-                return socket.inet_ntoa(data[4:8])
-        return None
-
     def process(self, buf, addr, respond):
         try:
             query = DNSRecord.parse(buf)
             logging.debug("DNS Q %s FROM: %s:%d" % (query.q.qname, addr[0], addr[1]))
-            answer = self._handler.handle(query)
+            answer = resolve(self._handler, query, wire.MAX_UDP)
 
             # respond on requested interface
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.bind((respond, self._port))
-            sock.sendto(answer.pack(), addr)
+            self._sock.sendmsg([answer], respond, 0, addr)
+
+        except Exception:
+            traceback.print_exc()
+
+    def overload(self, buf, question, addr, respond):
+        if self._overload != OVERLOAD_SERVFAIL:
+            self.stats['dropped'] += 1
+            return
+
+        self._sock.sendmsg([wire.error(buf, question, RCODE.SERVFAIL)], respond, 0, addr)
+        self.stats['servfail'] += 1
+
+
+class TcpServer(MuxServer):
+    def __init__(self, addr, handler: Handler, workers=16, queue_size=1024, overload=OVERLOAD_SERVFAIL,
+                 idle_timeout=10, max_connections=256):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.setblocking(False)
+        self._sock.bind(addr)
+        self._sock.listen(128)
+        self._handler = handler
+        self._overload = overload
+        self._mux = None
+
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.connections = set()
+        self.workers = Workers(self.process, workers or 1, queue_size)
+        self.stats = Counter()
+
+    def attach(self, mux):
+        self._mux = mux
+
+    def read(self):
+        try:
+            sock, addr = self._sock.accept()
+        except BlockingIOError:
+            return
+
+        if len(self.connections) >= self.max_connections:
+            self.stats['refused'] += 1
             sock.close()
+            return
+
+        self.stats['accepted'] += 1
+        connection = TcpConnection(self, sock, addr)
+        self.connections.add(connection)
+        self._mux.add(connection)
+
+    def write(self):
+        pass
+
+    def wqlen(self):
+        return 0
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def submit(self, connection, buf):
+        self.stats['received'] += 1
+
+        try:
+            question = wire.parse_question(buf)
+        except wire.MalformedMessage:
+            self.stats['malformed'] += 1
+            connection.reply(None)
+            return
+
+        answer = self._handler.cached(question, buf)
+        if answer is not None:
+            self.stats['cached'] += 1
+            connection.reply(finish(answer, question.payload, wire.MAX_TCP))
+            return
 
+        if self.workers.submit(connection, buf):
+            return
+
+        if self._overload != OVERLOAD_SERVFAIL:
+            self.stats['dropped'] += 1
+            connection.reply(None)
+            return
+
+        connection.reply(wire.error(buf, question, RCODE.SERVFAIL))
+        self.stats['servfail'] += 1
+
+    def process(self, connection, buf):
+        answer = None
+        try:
+            query = DNSRecord.parse(buf)
+            logging.debug("DNS Q %s FROM: %s:%d (tcp)" % (query.q.qname, connection.addr[0], connection.addr[1]))
+            answer = resolve(self._handler, query, wire.MAX_TCP)
         except Exception:
             traceback.print_exc()
+        finally:
+            connection.reply(answer)
+
+    def discard(self, connection):
+        self.connections.discard(connection)
+        self._mux.remove(connection)
+
+
+class TcpConnection(MuxServer):
+    def __init__(self, server: TcpServer, sock, addr):
+        sock.setblocking(False)
+        self._server = server
+        self._sock = sock
+        self._lock = threading.Lock()
+        self._inbuf = bytearray()
+        self._outbuf = bytearray()
+
+        self.addr = addr
+        self.pending = 0
+        self.closed = False
+        self.last = time.monotonic()
+
+    def read(self):
+        try:
+            data = self._sock.recv(wire.MAX_TCP)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            self.close()
+            return
+
+        self.last = time.monotonic()
+        self._inbuf += data
+
+        # rfc 7766: queries may be pipelined, answers go out as they are ready
+        while len(self._inbuf) >= 2:
+            size = int.from_bytes(self._inbuf[:2], 'big')
+            if len(self._inbuf) < 2 + size:
+                break
+            buf = bytes(self._inbuf[2:2 + size])
+            del self._inbuf[:2 + size]
+
+            with self._lock:
+                self.pending += 1
+            self._server.submit(self, buf)
+
+    def reply(self, answer):
+        with self._lock:
+            self.pending -= 1
+            if answer is not None:
+                self._outbuf += len(answer).to_bytes(2, 'big') + answer
+                self._flush()
+
+    def write(self):
+        with self._lock:
+            self._flush()
+
+    def wqlen(self):
+        return len(self._outbuf)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def tick(self):
+        if self.closed or self.pending or self._outbuf:
+            return
+        if time.monotonic() - self.last > self._server.idle_timeout:
+            self._server.stats['idle'] += 1
+            self.close()
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self._sock.close()
+        self._server.discard(self)
+
+    def _flush(self):
+        if self.closed:
+            self._outbuf.clear()
+            return
+
+        try:
+            sent = self._sock.send(self._outbuf)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._outbuf.clear()
+            return
+
+        del self._outbuf[:sent]
+        self.last = time.monotonic()
@@ -0,0 +1,81 @@
+from fnmatch import fnmatch
+from dnslib import DNSLabel
+
+GLOB_CHARS = frozenset(b'*?[')
+
+
+def is_glob(label):
+    return not GLOB_CHARS.isdisjoint(label)
+
+
+class Node:
+    __slots__ = ('children', 'exact', 'wildcard', 'globs')
+
+    def __init__(self):
+        self.children = {}
+        self.exact = []
+        self.wildcard = []
+        self.globs = []
+
+
+# matchGlob patterns keyed by their literal label suffix: a bare '*' in front
+# matches anything below the suffix, other globs fall back to fnmatch but only
+# for names already sharing the suffix, so a lookup is one dict hit per label
+class Trie:
+    def __init__(self):
+        self._root = Node()
+        self._any = []
+        self._seq = 0
+
+    def __len__(self):
+        return self._seq
+
+    def add(self, pattern, value):
+        self._seq += 1
+        item = (self._seq, value)
+
+        labels = () if pattern is None else DNSLabel(pattern).label
+        if pattern is None or labels == (b'*',):
+            self._any.append(item)
+            return
+
+        node = self._root
+        idx = len(labels)
+        while idx and not is_glob(labels[idx - 1]):
+            node = node.children.setdefault(labels[idx - 1].lower(), Node())
+            idx -= 1
+
+        if idx == 0:
+            node.exact.append(item)
+        elif labels[:idx] == (b'*',):
+            node.wildcard.append(item)
+        else:
+            node.globs.append((str(DNSLabel(labels)).lower(), item))
+
+    def lookup(self, qname: DNSLabel):
+        found = list(self._any)
+        name = None
+
+        node = self._root
+        labels = qname.label
+        for idx in range(len(labels) - 1, -1, -1):
+            found.extend(node.wildcard)
+            if node.globs:
+                name = name or str(qname).lower()
+                found.extend(item for (pattern, item) in node.globs if fnmatch(name, pattern))
+
+            node = node.children.get(labels[idx].lower())
+            if node is None:
+                break
+        else:
+            found.extend(node.exact)
+
+        found.sort(key=lambda item: item[0])
+
+        values, seen = [], set()
+        for (_, value) in found:
+            if id(value) not in seen:
+                seen.add(id(value))
+                values.append(value)
+
+        return values
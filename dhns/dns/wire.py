@@ -0,0 +1,238 @@
+import struct, re
+from collections import namedtuple
+
+Header = struct.Struct('!HHHHHH')
+UInt16 = struct.Struct('!H')
+UInt32 = struct.Struct('!I')
+
+# root name, type, payload size, extended rcode and flags, empty rdata
+Opt = struct.Struct('!BHHIH')
+# an rr after its name
+Rr = struct.Struct('!HHIH')
+
+QTYPE_OPT = 41
+
+# rfc 8767 suggests 30 seconds for answers served past their expiry
+STALE_TTL = 30
+
+FLAG_QR = 0x8000
+FLAG_RD = 0x0100
+FLAG_TC = 0x0200
+MASK_OPCODE = 0x7800
+
+MAX_UDP = 512
+MAX_TCP = 65535
+# dns flag day 2020: large enough for most answers, small enough to avoid fragmentation
+EDNS_PAYLOAD = 1232
+
+# labels dnslib would print verbatim, anything else takes the slow path
+RE_PLAIN = re.compile(rb'^[A-Za-z0-9_*-]+$')
+
+Question = namedtuple('Question', 'id, rd, name, qtype, qclass, end, payload')
+
+
+def key(qname, qtype, qclass):
+    return qname.rstrip('.').lower(), qtype, qclass
+
+
+def skip_name(buf, pos):
+    while True:
+        if pos >= len(buf):
+            raise MalformedMessage('name runs past end at %d' % pos)
+        length = buf[pos]
+        if length == 0:
+            return pos + 1
+        if length & 0xc0 == 0xc0:
+            if pos + 2 > len(buf):
+                raise MalformedMessage('pointer runs past end at %d' % pos)
+            return pos + 2
+        if length & 0xc0:
+            raise MalformedMessage('bad label type at %d' % pos)
+        pos += 1 + length
+
+
+def question_end(buf):
+    qdcount, = UInt16.unpack_from(buf, 4)
+
+    pos = Header.size
+    for _ in range(qdcount):
+        pos = skip_name(buf, pos) + 4
+
+    if pos > len(buf):
+        raise MalformedMessage('question runs past end at %d' % pos)
+
+    return pos
+
+
+def parse_question(buf):
+    view = memoryview(buf)
+    if len(view) < Header.size:
+        raise MalformedMessage('%d bytes' % len(view))
+
+    txid, flags, qdcount, ancount, nscount, arcount = Header.unpack_from(view)
+    if flags & FLAG_QR:
+        raise MalformedMessage('not a query')
+    if qdcount != 1:
+        raise MalformedMessage('%d questions' % qdcount)
+
+    labels = []
+    plain = True
+    pos = Header.size
+    while True:
+        if pos >= len(view):
+            raise MalformedMessage('name runs past end at %d' % pos)
+        length = view[pos]
+        if length == 0:
+            pos += 1
+            break
+        if length & 0xc0:
+            raise MalformedMessage('compressed question name at %d' % pos)
+        label = bytes(view[pos + 1:pos + 1 + length])
+        if len(label) != length:
+            raise MalformedMessage('label runs past end at %d' % pos)
+        plain = plain and RE_PLAIN.match(label) is not None
+        labels.append(label)
+        pos += 1 + length
+
+    if pos + 4 > len(view):
+        raise MalformedMessage('question runs past end at %d' % pos)
+    qtype, qclass = UInt16.unpack_from(view, pos)[0], UInt16.unpack_from(view, pos + 2)[0]
+    end = pos + 4
+
+    # only the common shape of a lone opt record is looked at, anything fancier goes to dnslib
+    payload = None
+    if arcount and (ancount or nscount or arcount > 1):
+        plain = False
+    elif arcount:
+        if end + 1 + Rr.size > len(view) or view[end] != 0:
+            plain = False
+        else:
+            rtype, rclass, _, rdlength = Rr.unpack_from(view, end + 1)
+            if rtype != QTYPE_OPT:
+                plain = False
+            elif end + 1 + Rr.size + rdlength > len(view):
+                raise MalformedMessage('opt record runs past end at %d' % end)
+            else:
+                payload = max(MAX_UDP, rclass)
+
+    name = b'.'.join(labels).decode('ascii').lower() if plain else None
+    return Question(txid, bool(flags & FLAG_RD), name, qtype, qclass, end, payload)
+
+
+def error(buf, question, rcode):
+    out = bytearray(buf[:question.end])
+
+    flags, = UInt16.unpack_from(out, 2)
+    UInt16.pack_into(out, 2, FLAG_QR | flags & (MASK_OPCODE | FLAG_RD) | rcode)
+    for offset in (6, 8, 10):
+        UInt16.pack_into(out, offset, 0)
+
+    return out
+
+
+def ttl_offsets(buf):
+    _, _, _, ancount, nscount, arcount = Header.unpack_from(buf)
+
+    pos = question_end(buf)
+    offsets = []
+    for _ in range(ancount + nscount + arcount):
+        pos = skip_name(buf, pos)
+        if pos + 10 > len(buf):
+            raise MalformedMessage('record runs past end at %d' % pos)
+        rtype, = UInt16.unpack_from(buf, pos)
+        rdlength, = UInt16.unpack_from(buf, pos + 8)
+        # the opt pseudo record keeps flags where other records keep their ttl
+        if rtype != QTYPE_OPT:
+            offsets.append(pos + 4)
+        pos += 10 + rdlength
+
+    if pos > len(buf):
+        raise MalformedMessage('record runs past end at %d' % pos)
+
+    return offsets
+
+
+def truncate(buf, limit):
+    if len(buf) <= limit:
+        return buf
+
+    # rfc 2181: drop whole sections rather than hand out a partial rrset
+    end = question_end(buf)
+    out = bytearray(buf[:end])
+
+    flags, = UInt16.unpack_from(out, 2)
+    UInt16.pack_into(out, 2, flags | FLAG_TC)
+    for offset in (6, 8, 10):
+        UInt16.pack_into(out, offset, 0)
+
+    return out
+
+
+def add_opt(buf, payload):
+    out = bytearray(buf)
+
+    arcount, = UInt16.unpack_from(out, 10)
+    UInt16.pack_into(out, 10, arcount + 1)
+    out += Opt.pack(0, QTYPE_OPT, payload, 0, 0)
+
+    return out
+
+
+class Entry:
+    __slots__ = ('wire', 'end', 'ttls', 'stored', 'expires', 'kind', 'hits', 'last')
+
+    def __init__(self, wire, stored, ttl, kind=None):
+        wire = bytearray(wire)
+        ttls = []
+        for offset in ttl_offsets(wire):
+            value = min(UInt32.unpack_from(wire, offset)[0], ttl)
+            UInt32.pack_into(wire, offset, value)
+            ttls.append((offset, value))
+
+        self.wire = bytes(wire)
+        self.end = question_end(wire)
+        self.ttls = tuple(ttls)
+        self.stored = stored
+        self.expires = stored + ttl
+        self.kind = kind
+        self.hits = 0
+        self.last = stored
+
+    def touch(self, now):
+        self.hits += 1
+        self.last = now
+
+    def render(self, txid, rd, now, question=None):
+        buf = self._header(txid, rd, question)
+
+        elapsed = int(now - self.stored)
+        if elapsed > 0:
+            for (offset, ttl) in self.ttls:
+                UInt32.pack_into(buf, offset, max(0, ttl - elapsed))
+
+        return buf
+
+    def render_stale(self, txid, rd, ttl=STALE_TTL, question=None):
+        buf = self._header(txid, rd, question)
+
+        for (offset, _) in self.ttls:
+            UInt32.pack_into(buf, offset, ttl)
+
+        return buf
+
+    def _header(self, txid, rd, question):
+        buf = bytearray(self.wire)
+
+        # the question goes back exactly as the client spelled it, 0x20 case and all
+        if question is not None and len(question) == self.end - Header.size:
+            buf[Header.size:self.end] = question
+        UInt16.pack_into(buf, 0, txid)
+
+        flags, = UInt16.unpack_from(buf, 2)
+        UInt16.pack_into(buf, 2, flags | FLAG_RD if rd else flags & ~FLAG_RD)
+
+        return buf
+
+
+class MalformedMessage(Exception):
+    pass
@@ -3,11 +3,18 @@ from select import select
 
 class Multiplexer:
     def __init__(self, *args):
-        self.servers = list(args)
+        self.servers = []
         self.running = False
+        for server in args:
+            self.add(server)
 
     def add(self, server):
         self.servers.append(server)
+        server.attach(self)
+
+    def remove(self, server):
+        if server in self.servers:
+            self.servers.remove(server)
 
     def start(self):
             self.running = True
@@ -17,6 +24,8 @@ class Multiplexer:
                     srv.read()
                 for srv in w:
                     srv.write()
+                for srv in list(self.servers):
+                    srv.tick()
 
     def stop(self):
         self.running = False
@@ -32,6 +41,12 @@ class Server:
     def wqlen(self):
         raise NotImplemented
 
+    def tick(self):
+        pass
+
+    def attach(self, mux):
+        pass
+
     def fileino(self):
         raise NotImplemented
 
@@ -0,0 +1,25 @@
+import socket, struct
+
+
+IP_PKTINFO = getattr(socket, 'IP_PKTINFO', 8)
+
+# struct in_pktinfo { int ipi_ifindex; struct in_addr ipi_spec_dst; struct in_addr ipi_addr; }
+InPktinfo = struct.Struct('=i4s4s')
+
+
+def enable(sock):
+    sock.setsockopt(socket.SOL_IP, IP_PKTINFO, 1)
+
+
+def received(ancdata):
+    for level, type, data in ancdata:
+        if level == socket.SOL_IP and type == IP_PKTINFO:
+            ifindex, spec_dst, _ = InPktinfo.unpack_from(data)
+            return ifindex, socket.inet_ntoa(spec_dst)
+    return 0, None
+
+
+def source(ifindex, address):
+    if address is None:
+        return []
+    return [(socket.SOL_IP, IP_PKTINFO, InPktinfo.pack(ifindex, socket.inet_aton(address), bytes(4)))]
@@ -0,0 +1,30 @@
+import heapq, itertools
+
+
+class Deadlines:
+    def __init__(self):
+        self._heap = []
+        self._when = {}
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._when)
+
+    def schedule(self, key, when):
+        self._when[key] = when
+        heapq.heappush(self._heap, (when, next(self._seq), key))
+
+        # rescheduling leaves stale entries behind, drop them once they pile up
+        if len(self._heap) > 2 * len(self._when) + 64:
+            self._heap = [(when, next(self._seq), key) for (key, when) in self._when.items()]
+            heapq.heapify(self._heap)
+
+    def cancel(self, key):
+        self._when.pop(key, None)
+
+    def expired(self, now):
+        while self._heap and self._heap[0][0] <= now:
+            when, _, key = heapq.heappop(self._heap)
+            if self._when.get(key) == when:
+                del self._when[key]
+                yield key
@@ -0,0 +1,53 @@
+import queue, threading, time
+
+
+class Workers:
+    def __init__(self, target, count=16, size=1024):
+        self._target = target
+        self._queue = queue.Queue(size)
+        self._lock = threading.Lock()
+
+        self.processed = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.wait_avg = 0.0
+        self.wait_max = 0.0
+
+        for _ in range(count):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, *args):
+        try:
+            self._queue.put_nowait((time.monotonic(), args))
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+        depth = self._queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+        return True
+
+    def metrics(self):
+        return {
+            'depth': self._queue.qsize(),
+            'max_depth': self.max_depth,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'wait_avg': self.wait_avg,
+            'wait_max': self.wait_max,
+        }
+
+    def _run(self):
+        while True:
+            queued, args = self._queue.get()
+            waited = time.monotonic() - queued
+
+            with self._lock:
+                self.processed += 1
+                self.wait_avg += (waited - self.wait_avg) / 64
+                if waited > self.wait_max:
+                    self.wait_max = waited
+
+            self._target(*args)